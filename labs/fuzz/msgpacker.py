@@ -142,20 +142,37 @@ class encoder:
     def get_buf(self):
         return bytes(self.buf)
 
+structs = {}
+
 class decoder:
     def __init__(self, data):
-        self.buf = data
+        ## Read through a view of the input at an offset, so that nothing
+        ## is copied except str and bin payloads.
+        self.data = memoryview(data)
+        self.pos = 0
+
+    @property
+    def buf(self):
+        ## The input not yet decoded.
+        return bytes(self.data[self.pos:])
 
     def get(self, n):
-        if len(self.buf) < n:
+        end = self.pos + n
+        if end > len(self.data):
             raise BadEncodingException('not enough data: need', n)
-        d = self.buf[:n]
-        self.buf = self.buf[n:]
+        d = self.data[self.pos:end]
+        self.pos = end
         return d
 
     def unpack(self, fmt):
-        n = struct.calcsize(fmt)
-        return struct.unpack(fmt, self.get(n))
+        s = structs.get(fmt)
+        if s is None:
+            s = structs[fmt] = struct.Struct(fmt)
+        if self.pos + s.size > len(self.data):
+            raise BadEncodingException('not enough data: need', s.size)
+        res = s.unpack_from(self.data, self.pos)
+        self.pos += s.size
+        return res
 
     def unpack_one(self, fmt):
         return self.unpack(fmt)[0]
@@ -185,7 +202,7 @@ class decoder:
             raise BadEncodingException(b)
         sbytes = self.get(strlen)
         try:
-            return sbytes.decode('utf-8')
+            return str(sbytes, 'utf-8')
         except UnicodeDecodeError as e:
             raise BadEncodingException(e)
 
@@ -198,7 +215,7 @@ class decoder:
             blen = self.unpack_one('>L')
         else:
             raise BadEncodingException(b)
-        return self.get(blen)
+        return bytes(self.get(blen))
 
     def decode_dict(self, b):
         if 0x80 <= b < 0x8f:
@@ -246,7 +263,10 @@ class decoder:
             return b-256
 
     def decode(self):
-        b = self.get(1)[0]
+        if self.pos >= len(self.data):
+            raise BadEncodingException('not enough data: need', 1)
+        b = self.data[self.pos]
+        self.pos += 1
         if 0x00 <= b < 0x7f or 0xe0 <= b < 0xff:
             return self.decode_fixint(b)
         elif b == 0xcc:
@@ -0,0 +1,32 @@
+import struct
+import time
+import msgpacker
+
+## Decoding time should grow linearly with message size: the per-MB time
+## below should stay flat as n doubles.
+
+def encode(x):
+    enc = msgpacker.encoder()
+    enc.encode(x)
+    return enc.get_buf()
+
+def array_message(n):
+    return encode([("s%d" % (i % 1000), i % 100, b"xy" * 8) for i in range(n)])
+
+def map_message(n):
+    ## The encoder only writes maps of up to 16 entries, so put the map32
+    ## header together by hand.
+    buf = bytearray(b"\xdf" + struct.pack(">L", n))
+    for i in range(n):
+        buf += encode("k%d" % i)
+        buf += encode(("v", i % 100, b"xy" * 8))
+    return bytes(buf)
+
+for (name, make) in (("array", array_message), ("map", map_message)):
+    for n in (50000, 100000, 200000, 400000):
+        data = make(n)
+        start = time.perf_counter()
+        msgpacker.decoder(data).decode()
+        elapsed = time.perf_counter() - start
+        mb = len(data) / 2**20
+        print("%s n=%d: %.1f MB in %.2fs, %.3fs/MB" % (name, n, mb, elapsed, elapsed / mb))
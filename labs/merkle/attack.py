@@ -1,20 +1,4 @@
-import bitstring
-import hashlib
-
-def H(*args):
-    return hashlib.sha256(b''.join(args)).digest()
-
-def H_empty():
-    return b''
-
-def H_kv(key, val):
-    return H(key, val)
-
-def H_internal(children):
-    return H(children[0], children[1])
-
-def traversal_path(key):
-    return bitstring.BitArray(H(key))
+from common import H_empty, H_kv, H_internal, traversal_path
 
 
 class AttackOne:
@@ -0,0 +1,306 @@
+import argparse
+import binascii
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+import json
+import tracemalloc
+import requests
+import werkzeug.serving
+import client
+import common
+import server
+import store
+import wire
+
+def make_items(n):
+    return [(b'k%d' % i, b'v%d' % i) for i in range(n)]
+
+def count_nodes(root):
+    nodes = 0
+    stack = [root]
+    while stack:
+        n = stack.pop()
+        nodes += 1
+        if isinstance(n, store.InternalNode):
+            stack.extend(n._children)
+    return nodes
+
+def bench_memory(n):
+    items = make_items(n)
+    tracemalloc.start()
+    start = time.perf_counter()
+    s = store.Store.from_items(items)
+    elapsed = time.perf_counter() - start
+    (used, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("memory n=%d: %d nodes, %.1f MB (%.0f bytes/key), peak %.1f MB, build %.1fs" %
+          (n, count_nodes(s.root), used / 2**20, used / n, peak / 2**20, elapsed))
+
+def bench_path(n):
+    ## Client.insert and Client.validate throughput, followed by the cost of
+    ## computing a path and reading the bits a proof of typical depth needs,
+    ## against the old bitstring.BitArray paths if bitstring is installed.
+    items = make_items(n)
+    c = client.Client(store.Store())
+    start = time.perf_counter()
+    for (k, v) in items:
+        c.insert(k, v)
+    insert_time = time.perf_counter() - start
+
+    proofs = [c._store.lookup(k) for (k, _) in items]
+    start = time.perf_counter()
+    for ((k, _), p) in zip(items, proofs):
+        c.validate(k, p)
+    validate_time = time.perf_counter() - start
+    print("path n=%d: client insert %.0f ops/s, validate %.0f ops/s" %
+          (n, n / insert_time, n / validate_time))
+
+    ## Lookups and checks of 100 hot keys, each of which computes the path
+    ## twice, without and with the path cache.
+    hot = [k for (k, _) in items[:100]] * max(1, n // 100)
+    for maxsize in (0, 1024):
+        common.set_path_cache(maxsize)
+        start = time.perf_counter()
+        for k in hot:
+            c.validate(k, c._store.lookup(k))
+        print("path n=%d: hot-key lookup and validate, path cache %d: %.0f ops/s" %
+              (n, maxsize, len(hot) / (time.perf_counter() - start)))
+    common.set_path_cache(0)
+
+    depth = max(len(p.siblings) for p in proofs)
+    variants = [("int", common.traversal_path)]
+    try:
+        import bitstring
+        variants.append(("bitstring", lambda key: bitstring.BitArray(common.H(key))))
+    except ImportError:
+        pass
+    for (name, path_fn) in variants:
+        start = time.perf_counter()
+        for (k, _) in items:
+            path = path_fn(k)
+            for i in range(depth):
+                path[i]
+        print("path n=%d: %s paths, %d bits each, %.0f paths/s" %
+              (n, name, depth, n / (time.perf_counter() - start)))
+
+class QuietHandler(werkzeug.serving.WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+def serve(n, port):
+    s = store.Store.from_items(make_items(n))
+    werkzeug.serving.make_server('localhost', port, server.create_app(s), threaded=True,
+                                 request_handler=QuietHandler).serve_forever()
+
+def hammer(url, n, method, seconds, results):
+    session = requests.Session()
+    count = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        key = binascii.hexlify(b'k%d' % random.randrange(n)).decode('ascii')
+        if method == 'GET':
+            session.get('%s/%s' % (url, key)).raise_for_status()
+        else:
+            session.put('%s/%s' % (url, key), data=b'x').raise_for_status()
+        count += 1
+    results.put((method, count))
+
+def start_server(n):
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+    p = multiprocessing.Process(target=serve, args=(n, port), daemon=True)
+    p.start()
+    url = 'http://localhost:%d' % port
+    while True:
+        try:
+            requests.get('%s/00' % url)
+            return (p, url)
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+def bench_serve(n, seconds=3):
+    ## GET throughput as the number of concurrent readers grows, with one
+    ## writer issuing PUTs the whole time.  Clients are separate processes
+    ## so that they do not compete with the server for its GIL.
+    (p, url) = start_server(n)
+    try:
+        for readers in (1, 2, 4, 8):
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=hammer, args=(url, n, 'GET', seconds, results))
+                       for _ in range(readers)]
+            clients.append(multiprocessing.Process(target=hammer, args=(url, n, 'PUT', seconds, results)))
+            for c in clients:
+                c.start()
+            counts = {'GET': 0, 'PUT': 0}
+            for _ in clients:
+                (method, count) = results.get()
+                counts[method] += count
+            for c in clients:
+                c.join()
+            print("serve n=%d: %d readers + 1 writer: %.0f GET/s, %.0f PUT/s" %
+                  (n, readers, counts['GET'] / seconds, counts['PUT'] / seconds))
+    finally:
+        p.terminate()
+
+def bench_wire(n, rounds=5):
+    ## Encode and decode every proof in a tree of n keys, as JSON (what the
+    ## server sends by default) and in the binary format.
+    s = store.Store.from_items(make_items(n))
+    proofs = [s.lookup(k) for (k, _) in make_items(n)]
+    formats = [
+        ("json", lambda p: json.dumps(wire.proof_to_json(p)).encode('ascii'),
+                 lambda b: wire.proof_from_json(json.loads(b))),
+        ("binary", wire.encode_proof, wire.decode_proof),
+    ]
+    for (name, encode, decode) in formats:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encoded = [encode(p) for p in proofs]
+        encode_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for b in encoded:
+                decode(b)
+        decode_time = (time.perf_counter() - start) / rounds
+        print("wire %s n=%d: %.0f bytes/proof, encode %.0f proofs/s, decode %.0f proofs/s" %
+              (name, n, sum(len(b) for b in encoded) / n, n / encode_time, n / decode_time))
+
+def bench_build(n):
+    ## Building a fresh store in one process and in a process pool.
+    items = make_items(n)
+    roots = []
+    for workers in (None, os.cpu_count()):
+        start = time.perf_counter()
+        s = store.Store.from_items(items, workers=workers)
+        elapsed = time.perf_counter() - start
+        roots.append(s.root.hashval())
+        print("build n=%d: workers=%s %.1fs" % (n, workers or 1, elapsed))
+    if roots[0] != roots[1]:
+        raise Exception("parallel build produced a different root")
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def measure(ops):
+    ## Run each zero-argument callable in ops, timing them one by one.
+    latencies = []
+    for op in ops:
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'ops_per_sec': len(latencies) / sum(latencies),
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+    }
+
+def bench_suite(n, samples=2000):
+    ## Store.insert/lookup, Client.validate/insert and the Flask endpoints
+    ## against a store preloaded with n keys, each over the same number of
+    ## samples so that sizes are comparable.
+    s = store.Store.from_items(make_items(n))
+    m = min(n, samples)
+    present = [b'k%d' % random.randrange(n) for _ in range(m)]
+    fresh = [b'new%d' % i for i in range(m)]
+    results = {}
+
+    results['store.lookup'] = measure([lambda k=k: s.lookup(k) for k in present])
+    results['store.insert'] = measure([lambda k=k: s.insert(k, b'x') for k in fresh])
+
+    c = client.Client(s, s.root.hashval())
+    proofs = [(k, s.lookup(k)) for k in present]
+    results['client.validate'] = measure([lambda k=k, p=p: c.validate(k, p) for (k, p) in proofs])
+    results['client.insert'] = measure([lambda k=k: c.insert(k, b'y') for k in fresh])
+
+    http = server.create_app(s).test_client()
+    hexkeys = [binascii.hexlify(k).decode('ascii') for k in present]
+    results['http.get'] = measure([lambda k=k: http.get('/' + k) for k in hexkeys])
+    results['http.get.binary'] = measure([lambda k=k: http.get('/' + k, headers={'Accept': wire.BINARY_MIMETYPE})
+                                          for k in hexkeys])
+    results['http.put'] = measure([lambda k=k: http.put('/' + k, data=b'z') for k in hexkeys])
+    batches = [hexkeys[i:i+64] for i in range(0, m, 64)]
+    results['http.lookup64'] = measure([lambda b=b: http.post('/lookup', json={'keys': b}) for b in batches])
+
+    results['proof_bytes'] = {
+        'json': sum(len(json.dumps(wire.proof_to_json(p))) for (_, p) in proofs) / m,
+        'binary': sum(len(wire.encode_proof(p)) for (_, p) in proofs) / m,
+    }
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    for (name, r) in results.items():
+        if isinstance(r, dict) and 'ops_per_sec' in r:
+            print("suite n=%d: %-16s %9.0f ops/s  p50 %8.1fus  p99 %8.1fus" %
+                  (n, name, r['ops_per_sec'], r['p50_us'], r['p99_us']))
+    print("suite n=%d: proof bytes json %.0f, binary %.0f; peak RSS %s MB" %
+          (n, results['proof_bytes']['json'], results['proof_bytes']['binary'],
+           "%.0f" % results['peak_rss_mb'] if results['peak_rss_mb'] is not None else "?"))
+    return results
+
+def compare(results, baseline, threshold=0.10):
+    ## Report every throughput that moved more than threshold from the
+    ## baseline; return the number of regressions.
+    regressions = 0
+    for (name, by_size) in results.items():
+        for (n, metrics) in by_size.items():
+            for (op, r) in metrics.items():
+                try:
+                    old = baseline[name][n][op]['ops_per_sec']
+                except (KeyError, TypeError):
+                    continue
+                change = r['ops_per_sec'] / old - 1
+                if abs(change) > threshold:
+                    if change < 0:
+                        regressions += 1
+                    print("%s n=%s: %s %+.0f%% vs baseline (%.0f -> %.0f ops/s)%s" %
+                          (name, n, op, change * 100, old, r['ops_per_sec'],
+                           "  REGRESSION" if change < 0 else ""))
+    return regressions
+
+benches = {
+    "memory": (bench_memory, [100000, 1000000, 10000000]),
+    "path": (bench_path, [10000, 100000]),
+    "serve": (bench_serve, [10000]),
+    "wire": (bench_wire, [10000, 100000]),
+    "build": (bench_build, [100000, 1000000]),
+    "suite": (bench_suite, [10000, 100000, 1000000]),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma-separated key counts (default depends on the benchmark)")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare results with this earlier --json file")
+    parser.add_argument("names", nargs="*", default=list(benches), help="benchmarks to run")
+    args = parser.parse_args()
+
+    ## Benchmarks that return metrics have them saved and compared, keyed
+    ## by benchmark name and then key count.
+    results = {}
+    for name in args.names:
+        (f, sizes) = benches[name]
+        if args.sizes is not None:
+            sizes = [int(x) for x in args.sizes.split(',')]
+        for n in sizes:
+            r = f(n)
+            if r is not None:
+                results.setdefault(name, {})[str(n)] = r
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f)):
+                sys.exit(1)
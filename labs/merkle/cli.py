@@ -1,65 +1,309 @@
 import argparse
 import binascii
+import collections
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
 import client
-import common
+import sync
 import requests
+import requests.adapters
+import wire
 
 class RemoteStore:
-    def __init__(self, url):
+    def __init__(self, url, binary=True, pool_size=8):
         self._url = url.encode('utf-8')
+        ## One session keeps connections alive across requests; the pool is
+        ## sized for that many concurrent requests.
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        ## Ask for binary proofs; servers that only speak JSON ignore this.
+        self._headers = {'Accept': wire.BINARY_MIMETYPE if binary else 'application/json'}
 
-    def proof(self, response):
-        j = response.json()
-        k = j.get('key')
-        v = j.get('val')
-        if k is not None: k = binascii.unhexlify(k)
-        if v is not None: v = binascii.unhexlify(v)
-        p = common.Proof(k, v, [binascii.unhexlify(s) for s in j['siblings']])
+    def is_binary(self, response):
+        return response.headers.get('Content-Type', '').split(';')[0] == wire.BINARY_MIMETYPE
+
+    def version(self, response, p):
+        v = response.headers.get('X-Merkle-Version')
+        if v is not None and v != 'None':
+            p.version = int(v)
         return p
 
-    def lookup(self, key):
-        response = requests.get(b'%s/%s' % (self._url, binascii.hexlify(key)))
+    def proof(self, response):
+        response.raise_for_status()
+        if self.is_binary(response):
+            return self.version(response, wire.decode_proof(response.content))
+        return self.version(response, wire.proof_from_json(response.json()))
+
+    def multiproof(self, response):
+        response.raise_for_status()
+        if self.is_binary(response):
+            return self.version(response, wire.decode_multiproof(response.content))
+        return self.version(response, wire.multiproof_from_json(response.json()))
+
+    def lookup(self, key, version=None):
+        params = {} if version is None else {'version': version}
+        response = self._session.get(b'%s/%s' % (self._url, binascii.hexlify(key)),
+                                     headers=self._headers, params=params)
         return self.proof(response)
 
+    def lookup_many(self, keys, version=None):
+        j = {'keys': [binascii.hexlify(k).decode('ascii') for k in keys]}
+        if version is not None:
+            j['version'] = version
+        response = self._session.post(b'%s/lookup' % self._url, headers=self._headers, json=j)
+        return self.multiproof(response)
+
+    def changes(self, root_hash):
+        response = self._session.get(b'%s/changes' % self._url, params={'root': binascii.hexlify(root_hash)})
+        response.raise_for_status()
+        j = response.json()
+        items = {binascii.unhexlify(k): binascii.unhexlify(v) for (k, v) in j['items']}
+        mp = j['multiproof']
+        return (j['version'], binascii.unhexlify(j['root']), j['reset'], items,
+                None if mp is None else wire.multiproof_from_json(mp))
+
+    def subtrees(self, prefixes, version=None):
+        j = {'prefixes': prefixes}
+        if version is not None:
+            j['version'] = version
+        response = self._session.post(b'%s/subtrees' % self._url, json=j)
+        response.raise_for_status()
+        j = response.json()
+        return (j['version'], [wire.subtree_from_json(d) for d in j['subtrees']])
+
+    def versions(self):
+        response = self._session.get(b'%s/versions' % self._url)
+        response.raise_for_status()
+        return response.json()
+
     def insert(self, key, val):
-        response = requests.put(b'%s/%s' % (self._url, binascii.hexlify(key)), data=val)
+        response = self._session.put(b'%s/%s' % (self._url, binascii.hexlify(key)), data=val, headers=self._headers)
         return self.proof(response)
 
+    def insert_batch(self, items):
+        response = self._session.post(b'%s/insert' % self._url, headers=self._headers,
+                                      json={'items': [(binascii.hexlify(k).decode('ascii'),
+                                                       binascii.hexlify(v).decode('ascii')) for (k, v) in items]})
+        return self.multiproof(response)
+
     def reset(self):
-        requests.post(b'%s/reset' % self._url, b'')
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--print-proofs", default=False, action=argparse.BooleanOptionalAction, help="print proofs")
-parser.add_argument("--server", default="http://localhost:6160", help="server URL")
-parser.add_argument("--root-file", default="merkle.root", help="file containing merkle root")
-parser.add_argument("cmd", help="get, put, or reset")
-parser.add_argument("key", help="key to get or put", nargs="?")
-parser.add_argument("value", help="value for put", nargs="?")
-args = parser.parse_args()
-
-s = RemoteStore(args.server)
-try:
-    with open(args.root_file, 'rb') as f:
-        root_hash = binascii.unhexlify(f.readline().strip())
-    client = client.Client(s, root_hash)
-except FileNotFoundError:
-    client = client.Client(s)
-
-client.verbose_validate = args.print_proofs
-
-match args.cmd:
-    case 'get':
-        r = client.lookup(args.key.encode('utf-8'))
-        if r is None:
-            print(r)
-        else:
-            print(r.decode('utf-8'))
-    case 'put':
-        client.insert(args.key.encode('utf-8'), args.value.encode('utf-8'))
-    case 'reset':
-        client.reset()
-    case _:
-        parser.print_help()
-
-with open(args.root_file, 'wb') as f:
-    f.write(b'%s\n' % binascii.hexlify(client._root_hash))
+        self._session.post(b'%s/reset' % self._url, b'')
+
+def read_lines(path):
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    with f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if line:
+                yield line
+
+def batches(it, n):
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+def get_many(c, lines, batch_size, concurrency):
+    ## Keep up to concurrency batched lookups in flight, and print results
+    ## in input order as soon as each proof has been verified.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = collections.deque()
+        for keys in itertools.chain(batches(lines, batch_size), [None]):
+            if keys is not None:
+                pending.append((keys, pool.submit(c.lookup_many, keys)))
+            while pending and (keys is None or len(pending) >= concurrency):
+                (done_keys, future) = pending.popleft()
+                for (k, v) in zip(done_keys, future.result()):
+                    print("%s\t%s" % (k.decode('utf-8'), None if v is None else v.decode('utf-8')))
+
+def put_many(c, lines, batch_size):
+    ## Each batch proof is relative to the root left by the previous batch,
+    ## so batches go out one at a time over the pooled connection.
+    for batch in batches(lines, batch_size):
+        items = []
+        for line in batch:
+            (k, _, v) = line.partition(b'\t')
+            items.append((k, v))
+        c.insert_many(items)
+
+def read_root(path, c):
+    try:
+        with open(path, 'rb') as f:
+            c._root_hash = binascii.unhexlify(f.readline().strip())
+    except FileNotFoundError:
+        pass
+
+def write_root(path, c):
+    with open(path, 'wb') as f:
+        f.write(b'%s\n' % binascii.hexlify(c._root_hash))
+
+## The cache file holds the root it was verified against, then one
+## key<TAB>value line per result, in hex, with '-' for an absent key.  A
+## cache for any other root is ignored.
+def read_cache(path, c):
+    if c.cached() is None:
+        return
+    try:
+        with open(path, 'rb') as f:
+            if binascii.unhexlify(f.readline().strip()) != c._root_hash:
+                return
+            cache = c.cached()
+            for line in f:
+                (k, _, v) = line.strip().partition(b'\t')
+                cache[binascii.unhexlify(k)] = None if v == b'-' else binascii.unhexlify(v)
+    except FileNotFoundError:
+        pass
+
+def write_cache(path, c):
+    cache = c.cached()
+    if cache is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'%s\n' % binascii.hexlify(c._root_hash))
+        for (k, v) in cache.items():
+            f.write(b'%s\t%s\n' % (binascii.hexlify(k), b'-' if v is None else binascii.hexlify(v)))
+    os.replace(tmp, path)
+
+def run(c, cmd, key, value, lines, batch_size, concurrency, allow_reset=False):
+    match cmd:
+        case 'get':
+            r = c.lookup(key.encode('utf-8'))
+            if r is None:
+                print(r)
+            else:
+                print(r.decode('utf-8'))
+        case 'put':
+            c.insert(key.encode('utf-8'), value.encode('utf-8'))
+        case 'get-many':
+            get_many(c, lines, batch_size, concurrency)
+        case 'put-many':
+            put_many(c, lines, batch_size)
+        case 'reset':
+            c.reset()
+        case 'catch-up':
+            (version, items) = c.catch_up(allow_reset)
+            print("version %d: %d keys changed" % (version, len(items)))
+        case 'diff':
+            ## Compares the server with another one, not with our root.
+            for (k, v1, v2) in sync.diff(c._store, RemoteStore(key)):
+                print("%s\t%s\t%s" % tuple([None if x is None else x.decode('utf-8') for x in (k, v1, v2)]))
+        case _:
+            return False
+    return True
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    ## One JSON request per line, naming a command as on the command line
+    ## (lines of get-many and put-many in hex); one JSON reply per line
+    ## with what the command printed.  Requests run one at a time against
+    ## the daemon's client, whose root and cache stay in memory.
+    def handle(self):
+        for line in self.rfile:
+            req = json.loads(line)
+            out = io.StringIO()
+            error = None
+            lines = iter([binascii.unhexlify(l) for l in req.get('lines', [])])
+            try:
+                with contextlib.redirect_stdout(out):
+                    if not run(self.server.client, req['cmd'], req.get('key'), req.get('value'), lines,
+                               self.server.args.batch_size, self.server.args.concurrency, req.get('allow_reset', False)):
+                        error = "unknown command %s" % req['cmd']
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+            finally:
+                write_root(self.server.args.root_file, self.server.client)
+            self.wfile.write(json.dumps({'output': out.getvalue(), 'error': error}).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+def daemon(c, args):
+    ## Listens on a Unix socket that only our user can open: anyone who can
+    ## connect can run commands as this client.  Being stopped still saves
+    ## the root and cache.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(args.daemon_socket):
+        os.remove(args.daemon_socket)
+    umask = os.umask(0o177)
+    try:
+        srv = socketserver.UnixStreamServer(args.daemon_socket, DaemonHandler)
+    finally:
+        os.umask(umask)
+    with srv:
+        srv.client = c
+        srv.args = args
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.daemon_socket)
+
+def forward(args):
+    req = {'cmd': args.cmd, 'key': args.key, 'value': args.value, 'allow_reset': args.allow_reset}
+    if args.cmd in ('get-many', 'put-many'):
+        req['lines'] = [binascii.hexlify(l).decode('ascii') for l in read_lines(args.key or '-')]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.daemon_socket)
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        reply = json.loads(sock.makefile('rb').readline())
+    sys.stdout.write(reply['output'])
+    if reply['error'] is not None:
+        sys.exit(reply['error'])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--print-proofs", default=False, action=argparse.BooleanOptionalAction, help="print proofs")
+    parser.add_argument("--server", default="http://localhost:6160", help="server URL")
+    parser.add_argument("--binary", default=True, action=argparse.BooleanOptionalAction, help="request binary proofs")
+    parser.add_argument("--root-file", default="merkle.root", help="file containing merkle root")
+    parser.add_argument("--cache", default=False, action=argparse.BooleanOptionalAction, help="answer lookups from results already verified against the root, without asking the server (always on for daemon; off with --print-proofs)")
+    parser.add_argument("--cache-file", default="merkle.cache", help="file of lookup results verified against the root")
+    parser.add_argument("--concurrency", default=8, type=int, help="requests in flight for get-many")
+    parser.add_argument("--batch-size", default=64, type=int, help="keys per request for get-many and put-many")
+    parser.add_argument("--allow-reset", default=False, action=argparse.BooleanOptionalAction, help="let catch-up trust a reset on the server, which it can't verify")
+    parser.add_argument("--daemon", default=False, action=argparse.BooleanOptionalAction, help="send the command to a running daemon")
+    parser.add_argument("--daemon-socket", default="merkle.sock", help="Unix socket of the daemon")
+    parser.add_argument("cmd", help="get, put, get-many, put-many, reset, catch-up, diff, or daemon")
+    parser.add_argument("key", help="key to get or put; for get-many and put-many, a file of keys or key<TAB>value lines (default: stdin); for diff, the URL of the other server", nargs="?")
+    parser.add_argument("value", help="value for put", nargs="?")
+    args = parser.parse_args()
+
+    if (args.daemon or args.cmd == 'daemon') and not hasattr(socket, 'AF_UNIX'):
+        sys.exit("the daemon needs Unix sockets, which this platform does not have")
+    if args.daemon:
+        forward(args)
+        return
+
+    ## A cache hit proves nothing new: it neither notices a server that
+    ## lost its state nor has a proof to print.
+    s = RemoteStore(args.server, binary=args.binary, pool_size=args.concurrency)
+    c = client.Client(s, cache=(args.cache or args.cmd == 'daemon') and not args.print_proofs)
+    read_root(args.root_file, c)
+    read_cache(args.cache_file, c)
+
+    c.verbose_validate = args.print_proofs
+
+    try:
+        if args.cmd == 'daemon':
+            daemon(c, args)
+        elif not run(c, args.cmd, args.key, args.value, read_lines(args.key or '-'),
+                     args.batch_size, args.concurrency, args.allow_reset):
+            parser.print_help()
+    finally:
+        ## The client only moves its root after verifying a proof, so this
+        ## also keeps the verified prefix of a put-many that failed part way.
+        write_root(args.root_file, c)
+        write_cache(args.cache_file, c)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,92 @@
-from common import H_empty, H_kv, H_internal, traversal_path, Proof
+import bisect
+from common import H_empty, H_kv, H_internal, H_ext, traversal_path, path_order, Proof, PatriciaProof, MultiProof, CompressedSiblings
+
+def check_siblings(siblings):
+    if type(siblings) == CompressedSiblings:
+        siblings = siblings.hashes
+    assert(type(siblings) == list and all([type(s) == bytes for s in siblings]))
+
+def path_siblings(path, siblings):
+    ## Yield (depth, direction, sibling) from the deepest level up, pairing
+    ## path and siblings the way zip() would.  Compressed siblings are
+    ## expanded one at a time as they are reached.
+    n = min(len(path), len(siblings))
+    rev = reversed(siblings)
+    for _ in range(len(siblings) - n):
+        next(rev)
+    for depth in reversed(range(n)):
+        yield (depth, path[depth], next(rev))
+
+def subtree_hash(items, lo, hi, depth):
+    ## Hash of the subtree at depth that holds items[lo:hi], a list of
+    ## (path, key, val) sorted by path, laid out the way Store builds it.
+    if lo == hi:
+        return H_empty()
+    if hi - lo == 1:
+        (_, key, val) = items[lo]
+        return H_kv(key, val)
+    mid = bisect.bisect_left(items, True, lo, hi, key=lambda item: item[0][depth])
+    return H_internal((subtree_hash(items, lo, mid, depth + 1),
+                       subtree_hash(items, mid, hi, depth + 1)))
+
+def patricia_steps(path, steps):
+    ## Pair each step of a PatriciaProof with the depth it starts at, and
+    ## return them with the depth the path reaches.
+    res = []
+    depth = 0
+    for step in steps:
+        res.append((depth, step))
+        if type(step) == str:
+            if path.bits(depth, depth + len(step)) != step:
+                raise Exception("Path leaves an extension in proof")
+            depth += len(step)
+        else:
+            depth += 1
+    return (res, depth)
+
+def patricia_root(path, steps, node_hash):
+    for (depth, step) in reversed(steps):
+        if type(step) == str:
+            node_hash = H_ext(step, node_hash)
+        elif path[depth]:
+            node_hash = H_internal((step, node_hash))
+        else:
+            node_hash = H_internal((node_hash, step))
+    return node_hash
+
+def patricia_branch(path, depth, new_hash, other_hash):
+    if path[depth]:
+        return H_internal((other_hash, new_hash))
+    return H_internal((new_hash, other_hash))
 
 class Client:
-    def __init__(self, store, root_hash = H_empty()):
+    def __init__(self, store, root_hash = H_empty(), cache=False):
         self._store = store
         self._root_hash = root_hash
         self.verbose_validate = False
+        ## With cache, lookups without a version are answered from results
+        ## already verified against the current root.  Only for a client
+        ## that owns its store: one swapped in underneath it would not be
+        ## asked again.
+        self._cache = {} if cache else None
+        self._cache_root = root_hash
+
+    def cached(self):
+        ## Verified lookup results (key -> value, or None for absence) for
+        ## the current root, or None if caching is off.  Once the root
+        ## moves they no longer prove anything, so the cache starts over.
+        if self._cache is not None and self._cache_root != self._root_hash:
+            self._cache = {}
+            self._cache_root = self._root_hash
+        return self._cache
 
     def validate(self, path_key, proof):
+        if type(proof) == PatriciaProof:
+            return self.validate_patricia(path_key, proof)
         assert(type(proof) == Proof)
         assert(proof.key == None or type(proof.key) == bytes)
         assert(proof.val == None or type(proof.val) == bytes)
-        assert(type(proof.siblings) == list and all([type(s) == bytes for s in proof.siblings]))
+        check_siblings(proof.siblings)
 
         if proof.key is None and proof.val is None:
             node_hash = H_empty()
@@ -21,11 +97,11 @@ class Client:
             print("Proof of subtree: key=%s, val=%s, node_hash=%s" % (proof.key, proof.val, node_hash))
 
         path = traversal_path(path_key)
-        for (leaf_direction, sibling) in reversed(list(zip(path, proof.siblings))):
-            children = [None, None]
-            children[int(leaf_direction)] = node_hash
-            children[int(not leaf_direction)] = sibling
-            node_hash = H_internal(children)
+        for (depth, leaf_direction, sibling) in path_siblings(path, proof.siblings):
+            if leaf_direction:
+                node_hash = H_internal((sibling, node_hash))
+            else:
+                node_hash = H_internal((node_hash, sibling))
             if self.verbose_validate:
                 print("Traversal path for", path_key, "is", ("right" if leaf_direction else "left"))
                 print(("Right" if not leaf_direction else "Left"), "sibling hash from proof is", sibling)
@@ -38,18 +114,157 @@ class Client:
         if self._root_hash != node_hash:
             raise Exception("Root hash mismatch")
 
-    def lookup(self, key):
-        proof = self._store.lookup(key)
+    def validate_patricia(self, path_key, proof):
+        ## Return the path, its depth-annotated steps, and the depth where
+        ## the proof ends.
+        assert(type(proof) == PatriciaProof)
+        assert(proof.key == None or type(proof.key) == bytes)
+        assert(proof.val == None or type(proof.val) == bytes)
+        assert(type(proof.steps) == list and all([type(s) in (str, bytes) for s in proof.steps]))
+
+        path = traversal_path(path_key)
+        (steps, depth) = patricia_steps(path, proof.steps)
+        if proof.ext is not None:
+            (skip, child) = proof.ext
+            assert(type(skip) == str and type(child) == bytes)
+            if proof.key is not None or path.bits(depth, depth + len(skip)) == skip:
+                raise Exception("Extension does not end the path")
+            node_hash = H_ext(skip, child)
+        elif proof.key is None and proof.val is None:
+            node_hash = H_empty()
+        else:
+            node_hash = H_kv(proof.key, proof.val)
+
+        if self._root_hash != patricia_root(path, steps, node_hash):
+            raise Exception("Root hash mismatch")
+        return (path, steps, depth)
+
+    def _insert_patricia(self, key, val, proof):
+        ## Same as PatriciaInsertTraversal, on hashes.
+        (path, steps, depth) = self.validate_patricia(key, proof)
+        new_hash = H_kv(key, val)
+        if proof.ext is not None:
+            (skip, child) = proof.ext
+            shared = 0
+            while skip[shared] == ('1' if path[depth + shared] else '0'):
+                shared += 1
+            rest = child if shared + 1 == len(skip) else H_ext(skip[shared+1:], child)
+            new_hash = patricia_branch(path, depth + shared, new_hash, rest)
+            if shared:
+                new_hash = H_ext(skip[:shared], new_hash)
+        elif proof.key is not None and proof.key != key:
+            fork = path.common_prefix(traversal_path(proof.key))
+            new_hash = patricia_branch(path, fork, new_hash, H_kv(proof.key, proof.val))
+            if fork > depth:
+                new_hash = H_ext(path.bits(depth, fork), new_hash)
+        self._root_hash = patricia_root(path, steps, new_hash)
+
+    def _multi_hash(self, paths, lo, hi, depth, leaves, siblings, updates):
+        ## Return the (old, new) hash of the subtree at depth that the
+        ## paths in paths[lo:hi] enter; new differs from old only when
+        ## updates holds a (key, val) to insert for each path.
+        group = [leaves[i] for (_, i) in paths[lo:hi]]
+        if any(leaf[2] <= depth for leaf in group):
+            ## Every path in this subtree must stop at the same leaf here.
+            if any(leaf != group[0] or leaf[2] != depth for leaf in group):
+                raise Exception("Inconsistent leaves in multiproof")
+            (key, val, _) = group[0]
+            if key is None and val is None:
+                old_hash = H_empty()
+            else:
+                old_hash = H_kv(key, val)
+            if updates is None:
+                return (old_hash, old_hash)
+
+            items = {updates[i][0]: (path, updates[i][1]) for (path, i) in paths[lo:hi]}
+            if key is not None and key not in items:
+                items[key] = (traversal_path(key), val)
+            items = sorted([(path, k, v) for (k, (path, v)) in items.items()], key=path_order)
+            return (old_hash, subtree_hash(items, 0, len(items), depth))
+
+        mid = bisect.bisect_left(paths, True, lo, hi, key=lambda item: item[0][depth])
+        children = []
+        for (a, b) in ((lo, mid), (mid, hi)):
+            if a == b:
+                sibling = next(siblings, None)
+                if sibling is None:
+                    raise Exception("Missing sibling in multiproof")
+                children.append((sibling, sibling))
+            else:
+                children.append(self._multi_hash(paths, a, b, depth + 1, leaves, siblings, updates))
+
+        old_hash = H_internal((children[0][0], children[1][0]))
+        if updates is None:
+            return (old_hash, old_hash)
+        return (old_hash, H_internal((children[0][1], children[1][1])))
+
+    def validate_many(self, path_keys, multiproof, updates=None):
+        ## Check multiproof against the root and return the root after
+        ## inserting updates (a list of (key, val) matching path_keys), each
+        ## shared ancestor being hashed once for both.
+        assert(type(multiproof) == MultiProof)
+        assert(type(multiproof.leaves) == list and len(multiproof.leaves) == len(path_keys))
+        assert(all([type(l) == tuple and len(l) == 3 and type(l[2]) == int for l in multiproof.leaves]))
+        assert(all([l[0] == None or type(l[0]) == bytes for l in multiproof.leaves]))
+        assert(all([l[1] == None or type(l[1]) == bytes for l in multiproof.leaves]))
+        check_siblings(multiproof.siblings)
+
+        if not path_keys:
+            return self._root_hash
+
+        ## Rebuild the union of all paths once, so shared upper levels are
+        ## hashed a single time.
+        paths = sorted([(traversal_path(k), i) for (i, k) in enumerate(path_keys)], key=path_order)
+        siblings = iter(multiproof.siblings)
+        (old_hash, new_hash) = self._multi_hash(paths, 0, len(paths), 0, multiproof.leaves, siblings, updates)
+
+        if next(siblings, None) is not None:
+            raise Exception("Unused siblings in multiproof")
+        if self._root_hash != old_hash:
+            raise Exception("Root hash mismatch")
+        return new_hash
+
+    def lookup(self, key, version=None):
+        ## A version lets a client holding an older root hash (say, an
+        ## auditor) check a key against that root, if the store retains it.
+        cache = self.cached() if version is None else None
+        if cache is not None and key in cache:
+            return cache[key]
+        if version is None:
+            proof = self._store.lookup(key)
+        else:
+            proof = self._store.lookup(key, version)
         self.validate(key, proof)
 
         ## If we found the key, return it; otherwise (empty or other key), None
-        if proof.key == key:
-            return proof.val
-        else:
-            return None
+        val = proof.val if proof.key == key else None
+        if cache is not None:
+            cache[key] = val
+        return val
+
+    def lookup_many(self, keys, version=None):
+        cache = self.cached() if version is None else None
+        if cache is None:
+            if version is None:
+                multiproof = self._store.lookup_many(keys)
+            else:
+                multiproof = self._store.lookup_many(keys, version)
+            self.validate_many(keys, multiproof)
+            return [val if k == key else None for (key, (k, val, _)) in zip(keys, multiproof.leaves)]
+
+        ## Only the keys not already verified against this root go out.
+        missing = list(dict.fromkeys([key for key in keys if key not in cache]))
+        if missing:
+            multiproof = self._store.lookup_many(missing)
+            self.validate_many(missing, multiproof)
+            for (key, (k, val, _)) in zip(missing, multiproof.leaves):
+                cache[key] = val if k == key else None
+        return [cache[key] for key in keys]
 
     def insert(self, key, val):
         proof = self._store.insert(key, val)
+        if type(proof) == PatriciaProof:
+            return self._insert_patricia(key, val, proof)
         self.validate(key, proof)
 
         new_hash = H_kv(key, val)
@@ -58,27 +273,51 @@ class Client:
         if proof.key is not None and proof.key != key:
             old_path = traversal_path(proof.key)
 
-            match_depth = 0
-            while path[match_depth] == old_path[match_depth]:
-                match_depth += 1
-            fork_depth = match_depth + 1
+            fork_depth = path.common_prefix(old_path) + 1
 
             old_sibling = H_kv(proof.key, proof.val)
-            for leaf_direction in reversed(path[len(proof.siblings):fork_depth]):
-                children = [None, None]
-                children[int(leaf_direction)] = new_hash
-                children[int(not leaf_direction)] = old_sibling
-                new_hash = H_internal(children)
+            for depth in reversed(range(len(proof.siblings), fork_depth)):
+                if path[depth]:
+                    new_hash = H_internal((old_sibling, new_hash))
+                else:
+                    new_hash = H_internal((new_hash, old_sibling))
                 old_sibling = H_empty()
 
-        for (leaf_direction, sibling) in reversed(list(zip(path, proof.siblings))):
-            children = [None, None]
-            children[int(leaf_direction)] = new_hash
-            children[int(not leaf_direction)] = sibling
-            new_hash = H_internal(children)
+        for (depth, leaf_direction, sibling) in path_siblings(path, proof.siblings):
+            if leaf_direction:
+                new_hash = H_internal((sibling, new_hash))
+            else:
+                new_hash = H_internal((new_hash, sibling))
 
         self._root_hash = new_hash
 
+    def insert_many(self, items):
+        ## Later values win for repeated keys, as in Store.insert_batch.
+        updates = list(dict(items).items())
+        keys = [k for (k, _) in updates]
+        multiproof = self._store.insert_batch(updates)
+        self._root_hash = self.validate_many(keys, multiproof, updates)
+
+    def catch_up(self, allow_reset=False):
+        ## Move our root to the store's current one, checking that it comes
+        ## from ours through the inserts made since, and return (version,
+        ## items).  Only a reset among those writes can't be checked: the
+        ## new root is then just that of a tree holding the later inserts,
+        ## so it is refused unless allow_reset says to trust the store.
+        (version, root_hash, reset, items, multiproof) = self._store.changes(self._root_hash)
+        updates = list(items.items())
+        if reset:
+            if not allow_reset:
+                raise Exception("Changes include a reset, which can't be verified")
+            paths = sorted([(traversal_path(k), k, v) for (k, v) in updates], key=path_order)
+            new_hash = subtree_hash(paths, 0, len(paths), 0)
+        else:
+            new_hash = self.validate_many([k for (k, _) in updates], multiproof, updates)
+        if new_hash != root_hash:
+            raise Exception("Changes do not lead to the store's root")
+        self._root_hash = new_hash
+        return (version, items)
+
     def reset(self):
         self._store.reset()
         self._root_hash = H_empty()
@@ -1,5 +1,6 @@
+import collections.abc
+import functools
 import hashlib
-import bitstring
 
 def H(*args):
     return hashlib.sha256(b''.join(args)).digest()
@@ -13,13 +14,155 @@ def H_kv(key, val):
 def H_internal(children):
     return H(children[0], children[1])
 
+def H_ext(skip, child):
+    return H(skip.encode('ascii'), child)
+
+class Path:
+    ## The bits of a digest, most significant first, read straight out of
+    ## an int.  Indexing yields bools, and slicing yields lists of bools.
+    __slots__ = ('_bits', '_len')
+
+    def __init__(self, digest):
+        self._bits = int.from_bytes(digest, 'big')
+        self._len = len(digest) * 8
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if i < 0 or i >= self._len:
+            raise IndexError("path index out of range")
+        return (self._bits >> (self._len - 1 - i)) & 1 == 1
+
+    def __iter__(self):
+        return (b == '1' for b in format(self._bits, '0%db' % self._len))
+
+    def __eq__(self, other):
+        return isinstance(other, Path) and (self._bits, self._len) == (other._bits, other._len)
+
+    def __hash__(self):
+        return hash((self._bits, self._len))
+
+    def bits(self, lo, hi):
+        ## Bits lo up to hi as a string of '0' and '1'.
+        if hi <= lo:
+            return ''
+        return format((self._bits >> (self._len - hi)) & ((1 << (hi - lo)) - 1), '0%db' % (hi - lo))
+
+    def common_prefix(self, other):
+        ## Number of leading bits shared with other.
+        n = min(self._len, other._len)
+        diff = (self._bits >> (self._len - n)) ^ (other._bits >> (other._len - n))
+        return n - diff.bit_length()
+
+def _path(key):
+    return Path(H(key))
+
+_path_cache = None
+
+def set_path_cache(maxsize):
+    ## Remember the paths of up to maxsize recently used keys; 0 turns the
+    ## cache off.
+    global _path_cache
+    if maxsize:
+        _path_cache = functools.lru_cache(maxsize=maxsize)(_path)
+    else:
+        _path_cache = None
+
 def traversal_path(key):
-    return bitstring.BitArray(H(key))
+    if _path_cache is not None:
+        return _path_cache(key)
+    return _path(key)
+
+def path_order(item):
+    ## Sort key for (path, ...) tuples: left subtrees before right ones.
+    return item[0]._bits
 
 class Proof:
-    def __init__(self, key, val, siblings):
+    def __init__(self, key, val, siblings, version=None):
         self.key = key
         self.val = val
         self.siblings = siblings
+        ## The store version whose root this proof is against, if known.
+        self.version = version
+
+class PatriciaProof:
+    def __init__(self, key, val, steps, ext=None, version=None):
+        self.key = key
+        self.val = val
+        ## From the root down: a str of '0' and '1' for each extension the
+        ## path follows, and the sibling's hash for each internal node.
+        self.steps = steps
+        ## When the path leaves an extension part way, (skip, child hash)
+        ## of that extension, which then ends the proof in place of a leaf.
+        self.ext = ext
+        self.version = version
+
+
+
+class MultiProof:
+    def __init__(self, leaves, siblings, version=None):
+        ## leaves[i] is the (key, val, depth) of the leaf reached by the i-th
+        ## requested key, with key and val None for an empty leaf.  siblings
+        ## holds every hash not covered by the requested paths, in
+        ## depth-first, left-to-right order.
+        self.leaves = leaves
+        self.siblings = siblings
+        self.version = version
+
+class CompressedSiblings(collections.abc.Sequence):
+    ## A list of siblings stored as a bitmap of the ones that are H_empty()
+    ## (bit i for sibling i) plus the remaining hashes in order.  Most
+    ## siblings in a sparse tree are empty, so this grows with the number of
+    ## occupied levels; siblings are only expanded as they are read.
+    __slots__ = ('empty', 'hashes', '_len')
+
+    def __init__(self, n, empty, hashes):
+        if empty >> n or n - empty.bit_count() != len(hashes):
+            raise Exception("Sibling bitmap does not match hashes")
+        self._len = n
+        self.empty = empty
+        self.hashes = hashes
+
+    @classmethod
+    def compress(cls, siblings):
+        empty = 0
+        hashes = []
+        for (i, s) in enumerate(siblings):
+            if s == H_empty():
+                empty |= 1 << i
+            else:
+                hashes.append(s)
+        return cls(len(siblings), empty, hashes)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if i < 0 or i >= self._len:
+            raise IndexError("sibling index out of range")
+        if (self.empty >> i) & 1:
+            return H_empty()
+        return self.hashes[i - (self.empty & ((1 << i) - 1)).bit_count()]
 
+    def __iter__(self):
+        hashes = iter(self.hashes)
+        for i in range(self._len):
+            yield H_empty() if (self.empty >> i) & 1 else next(hashes)
 
+    def __reversed__(self):
+        j = len(self.hashes)
+        for i in reversed(range(self._len)):
+            if (self.empty >> i) & 1:
+                yield H_empty()
+            else:
+                j -= 1
+                yield self.hashes[j]
@@ -0,0 +1,243 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+import store
+import wal
+from common import traversal_path, path_order
+
+## Rough in-memory cost of a loaded node, for the cache budget.
+INTERNAL_COST = 250
+KEYVALUE_COST = 200
+
+## The node file starts with a header and is followed by append-only
+## records; a node is named by the offset of its record.  Offset 0 (the
+## header) stands for the empty node.
+MAGIC = b'MERKLE01'
+INTERNAL = 1
+KEYVALUE = 2
+internal_record = struct.Struct('>B32sQQ')
+keyvalue_record = struct.Struct('>B32sII')
+root_record = struct.Struct('>QQQ')
+
+class DiskInternalNode(store.InternalNode):
+    __slots__ = ('_nodes', '_offset', '_child_offsets')
+
+    def __init__(self, nodes, offset, hashval, child_offsets):
+        store.Node.__init__(self, hashval)
+        self._nodes = nodes
+        self._offset = offset
+        self._child_offsets = child_offsets
+
+    @property
+    def _children(self):
+        ## Children are read from the mapped file on every access rather
+        ## than kept in memory, so the tree can grow past RAM.
+        return [self._nodes.load(off) for off in self._child_offsets]
+
+class DiskKeyValueNode(store.KeyValueNode):
+    __slots__ = ('_nodes', '_offset')
+
+    def __init__(self, nodes, offset, hashval, key, val):
+        store.Node.__init__(self, hashval)
+        self._nodes = nodes
+        self._offset = offset
+        self._key = key
+        self._val = val
+
+class NodeFile:
+    ## Loaded nodes are kept in an LRU cache of about cache_bytes.  Nodes
+    ## not in it are only a hash and offsets away on disk, so memory stays
+    ## bounded however large the tree grows; the upper levels, used by
+    ## every lookup, are the last to be evicted.
+    def __init__(self, path, cache_bytes=64 * 2**20):
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = cache_bytes
+        self._cached_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._f = open(path, 'a+b')
+        self._end = self._f.seek(0, os.SEEK_END)
+        if self._end == 0:
+            self._f.write(MAGIC)
+            self._f.flush()
+            self._end = len(MAGIC)
+        self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise Exception("%s is not a merkle node file" % path)
+
+    def _read(self, off, n):
+        if off + n > len(self._map):
+            ## The file has grown since it was mapped.
+            self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[off:off+n]
+
+    def load(self, off):
+        if off == 0:
+            return store.EMPTY
+        with self._cache_lock:
+            node = self._cache.get(off)
+            if node is not None:
+                self._cache.move_to_end(off)
+                return node
+        node = self._load(off)
+        with self._cache_lock:
+            if off not in self._cache:
+                self._cache[off] = node
+                self._cached_bytes += self._cost(node)
+                while self._cached_bytes > self._cache_bytes and self._cache:
+                    (_, evicted) = self._cache.popitem(last=False)
+                    self._cached_bytes -= self._cost(evicted)
+        return node
+
+    def _cost(self, node):
+        if isinstance(node, DiskInternalNode):
+            return INTERNAL_COST
+        return KEYVALUE_COST + len(node._key) + len(node._val)
+
+    def _load(self, off):
+        kind = self._read(off, 1)[0]
+        if kind == INTERNAL:
+            (_, h, left, right) = internal_record.unpack(self._read(off, internal_record.size))
+            return DiskInternalNode(self, off, h, (left, right))
+        if kind == KEYVALUE:
+            (_, h, klen, vlen) = keyvalue_record.unpack(self._read(off, keyvalue_record.size))
+            kv = self._read(off + keyvalue_record.size, klen + vlen)
+            return DiskKeyValueNode(self, off, h, kv[:klen], kv[klen:])
+        raise Exception("bad node record at offset %d" % off)
+
+    def save(self, node, moved=None):
+        ## Append node and any of its descendants that are not yet on disk;
+        ## return the offset of node.  When copying nodes from another file,
+        ## moved maps their old offsets to new ones so that shared subtrees
+        ## are written once.
+        if isinstance(node, store.EmptyNode):
+            return 0
+        if getattr(node, '_nodes', None) is self:
+            return node._offset
+        if moved is not None and getattr(node, '_offset', None) in moved:
+            return moved[node._offset]
+        if isinstance(node, store.InternalNode):
+            (left, right) = [self.save(c, moved) for c in node._children]
+            rec = internal_record.pack(INTERNAL, node.hashval(), left, right)
+        else:
+            rec = keyvalue_record.pack(KEYVALUE, node.hashval(), len(node.key()), len(node.val()))
+            rec += node.key() + node.val()
+        off = self._end
+        self._f.write(rec)
+        self._end += len(rec)
+        if moved is not None and hasattr(node, '_offset'):
+            moved[node._offset] = off
+        return off
+
+    def flush(self, sync):
+        self._f.flush()
+        if sync:
+            os.fsync(self._f.fileno())
+
+class DiskStore(store.Store):
+    ## The root file names the node file in use (nodes.<generation>), the
+    ## offset of the current root in it, and the current version.  Only the
+    ## current version survives a restart.  With compact_ratio, the node
+    ## file is compacted whenever it grows to that many times its size
+    ## after the last compaction.
+    def __init__(self, directory, sync=False, retain=16, cache_bytes=64 * 2**20, chunk=100000, compact_ratio=None):
+        super().__init__(retain)
+        self._cache_bytes = cache_bytes
+        self._chunk = chunk
+        self._compact_ratio = compact_ratio
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._sync = sync
+        self._root_path = os.path.join(directory, 'root')
+        try:
+            with open(self._root_path, 'rb') as f:
+                (self._generation, off, self.version) = root_record.unpack(f.read())
+        except FileNotFoundError:
+            (self._generation, off) = (0, 0)
+        self._nodes = NodeFile(self._nodes_path(self._generation), cache_bytes)
+        self.root = self._nodes.load(off)
+        self._history.clear()
+        self._history.append((self.version, self.root))
+        self._compacted_end = self._nodes._end
+
+    def _nodes_path(self, generation):
+        return os.path.join(self._dir, 'nodes.%d' % generation)
+
+    def _write_root(self, generation, off, version, sync=False):
+        ## Called only once the nodes it names are on disk; the pointer
+        ## itself is replaced atomically, and with sync the rename is
+        ## durable before this returns.
+        sync = sync or self._sync
+        tmp = self._root_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(root_record.pack(generation, off, version))
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self._root_path)
+        if sync:
+            wal.sync_dir(self._dir)
+
+    def _update(self, root, change):
+        ## With a write-ahead log, the root file only moves at checkpoints,
+        ## once the nodes it names are synced; the log covers the rest.
+        off = self._nodes.save(root)
+        self._nodes.flush(self._sync)
+        if self.wal is None:
+            self._write_root(self._generation, off, self.version + 1)
+        super()._update(self._nodes.load(off), change)
+        if self._compact_ratio and self._nodes._end > self._compact_ratio * max(self._compacted_end, 2**20):
+            self._compact()
+
+    def _insert_items(self, items, workers=None):
+        ## Large batches are merged chunk by chunk, each written out before
+        ## the next, so only one chunk's new nodes are in memory at a time.
+        ## workers is ignored: a parallel build makes the whole tree in
+        ## memory before any of it could be written.
+        paths = sorted([(traversal_path(k), k, v) for (k, v) in items.items()], key=path_order)
+        root = self.root
+        for lo in range(0, len(paths), self._chunk):
+            root = store.build(root, paths, lo, min(lo + self._chunk, len(paths)), 0)
+            off = self._nodes.save(root)
+            self._nodes.flush(False)
+            root = self._nodes.load(off)
+        self._update(root, items)
+
+    def checkpoint(self):
+        ## Make the current root durable, after which the write-ahead log
+        ## has nothing left to replay.
+        self._nodes.flush(True)
+        self._write_root(self._generation, getattr(self.root, '_offset', 0), self.version, True)
+        if self.wal is not None:
+            self.wal.truncate()
+
+    def compact(self):
+        ## Copy the nodes that some retained version reaches into a fresh
+        ## node file and switch to it; everything else in the old file is
+        ## garbage.  Readers still holding nodes of the old file keep
+        ## reading it through its open mapping.
+        with self._write_lock:
+            self._compact()
+
+    def _compact(self):
+        ## Called with the write lock held.
+        generation = self._generation + 1
+        path = self._nodes_path(generation)
+        if os.path.exists(path):
+            os.remove(path)
+        nodes = NodeFile(path, self._cache_bytes)
+        moved = {}
+        offsets = [(v, nodes.save(root, moved)) for (v, root) in self._history]
+        nodes.flush(True)
+        ## The root file must name the new node file on disk before the old
+        ## one can go.
+        self._write_root(generation, offsets[-1][1], self.version, True)
+
+        old_path = self._nodes_path(self._generation)
+        (self._generation, self._nodes) = (generation, nodes)
+        self._history = collections.deque([(v, nodes.load(off)) for (v, off) in offsets],
+                                          maxlen=self._history.maxlen)
+        self.root = self._history[-1][1]
+        self._compacted_end = nodes._end
+        os.remove(old_path)
@@ -0,0 +1,190 @@
+import argparse
+import bisect
+import itertools
+import json
+import random
+import threading
+import time
+import cli
+import client
+
+## Load generator for a running server.  Worker threads issue a mix of GETs
+## and PUTs and check every proof.  It must be the server's only writer:
+## PUTs go out one at a time, so the root (and version) the writer ends up
+## with is always known, and each PUT publishes them.  GETs ask for the
+## current version, as clients normally do, so that the server's proof
+## cache is measured, and are checked against the last published root; a
+## GET that lands while a PUT is in flight is asked again at the published
+## version.  With --pin-version every GET names that version.
+
+class Timed:
+    ## Pass calls on to a RemoteStore, keeping the version of the last
+    ## proof and the CPU time spent on requests, so that the rest of a
+    ## Client call can be counted as verification.
+    def __init__(self, remote):
+        self._remote = remote
+        self.version = None
+        self.cpu = 0.0
+
+    def lookup(self, key, version=None):
+        start = time.thread_time()
+        p = self._remote.lookup(key, version)
+        self.cpu += time.thread_time() - start
+        self.version = p.version
+        return p
+
+    def insert(self, key, val):
+        start = time.thread_time()
+        p = self._remote.insert(key, val)
+        self.cpu += time.thread_time() - start
+        self.version = p.version
+        return p
+
+def key_chooser(keys, zipf, rng):
+    ## Keys k0 .. k<keys-1>, uniformly or with P(i) proportional to
+    ## 1/(i+1)**zipf.
+    if not zipf:
+        return lambda: b'k%d' % rng.randrange(keys)
+    cum = list(itertools.accumulate(1 / (i + 1) ** zipf for i in range(keys)))
+    return lambda: b'k%d' % bisect.bisect_left(cum, rng.random() * cum[-1])
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.verify_cpu = 0.0
+
+    def error(self, e):
+        name = type(e).__name__ + ": " + str(e).split('\n')[0][:80]
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def merge(self, other):
+        self.latencies += other.latencies
+        for (name, n) in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + n
+        self.verify_cpu += other.verify_cpu
+
+    def report(self, duration):
+        lat = sorted(self.latencies)
+        pct = lambda q: lat[min(len(lat) - 1, int(len(lat) * q))] * 1e3 if lat else 0.0
+        return {
+            'ops': len(lat),
+            'ops_per_sec': len(lat) / duration,
+            'p50_ms': pct(0.50),
+            'p90_ms': pct(0.90),
+            'p99_ms': pct(0.99),
+            'max_ms': lat[-1] * 1e3 if lat else 0.0,
+            'errors': self.errors,
+            'verify_cpu_sec': self.verify_cpu,
+        }
+
+class Load:
+    def __init__(self, args, root_hash, version):
+        self.args = args
+        self.deadline = time.monotonic() + args.duration
+        self.write_lock = threading.Lock()
+        ## The (version, root hash) of the last write, which GETs check.
+        self.published = (version, root_hash)
+        self.failed = False
+
+    def run_worker(self, seed, stats):
+        args = self.args
+        rng = random.Random(seed)
+        choose = key_chooser(args.keys, args.zipf, rng)
+        remote = Timed(cli.RemoteStore(args.server, binary=args.binary, pool_size=1))
+        while time.monotonic() < self.deadline and not self.failed:
+            key = choose()
+            put = rng.random() < args.put_fraction
+            start = time.perf_counter()
+            cpu = time.thread_time()
+            remote.cpu = 0.0
+            try:
+                if put:
+                    self.put(remote, key, b'%0*d' % (args.value_size, rng.randrange(10**args.value_size)))
+                else:
+                    self.get(remote, key)
+            except Exception as e:
+                stats[put].error(e)
+                if put:
+                    ## The server may have taken the write, so our root is
+                    ## no longer known and nothing more can be checked.
+                    self.failed = True
+                continue
+            stats[put].latencies.append(time.perf_counter() - start)
+            stats[put].verify_cpu += time.thread_time() - cpu - remote.cpu
+
+    def get(self, remote, key):
+        (version, root_hash) = self.published
+        c = client.Client(remote, root_hash)
+        if self.args.pin_version:
+            return c.lookup(key, version)
+        try:
+            return c.lookup(key)
+        except Exception:
+            if remote.version == version:
+                raise
+        return c.lookup(key, version)
+
+    def put(self, remote, key, val):
+        with self.write_lock:
+            (_, root_hash) = self.published
+            c = client.Client(remote, root_hash)
+            c.insert(key, val)
+            self.published = (remote.version + 1, c._root_hash)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", default="http://localhost:6160", help="server URL")
+    parser.add_argument("--binary", default=True, action=argparse.BooleanOptionalAction, help="request binary proofs")
+    parser.add_argument("--root-file", default="merkle.root", help="file containing merkle root, updated after the run")
+    parser.add_argument("--duration", default=10.0, type=float, help="seconds to run")
+    parser.add_argument("--concurrency", default=8, type=int, help="worker threads")
+    parser.add_argument("--put-fraction", default=0.1, type=float, help="fraction of operations that are PUTs")
+    parser.add_argument("--keys", default=10000, type=int, help="number of distinct keys")
+    parser.add_argument("--zipf", default=0.0, type=float, help="Zipf exponent for key choice (0 for uniform)")
+    parser.add_argument("--value-size", default=16, type=int, help="bytes per value written")
+    parser.add_argument("--pin-version", default=False, action=argparse.BooleanOptionalAction, help="name the published version in every GET (bypasses the proof cache)")
+    parser.add_argument("--seed", default=0, type=int, help="random seed")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    ## Start from the root the CLI last verified, and learn its version.
+    remote = Timed(cli.RemoteStore(args.server, binary=args.binary))
+    c = client.Client(remote)
+    cli.read_root(args.root_file, c)
+    c.lookup(b'k0')
+    load = Load(args, c._root_hash, remote.version)
+
+    stats = [(Stats(), Stats()) for _ in range(args.concurrency)]
+    threads = [threading.Thread(target=load.run_worker, args=(args.seed * 1000 + i, stats[i]))
+               for i in range(args.concurrency)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.monotonic() - start
+
+    c._root_hash = load.published[1]
+    cli.write_root(args.root_file, c)
+
+    (gets, puts) = (Stats(), Stats())
+    for (g, p) in stats:
+        gets.merge(g)
+        puts.merge(p)
+    report = {'duration_sec': duration, 'get': gets.report(duration), 'put': puts.report(duration)}
+    for op in ('get', 'put'):
+        r = report[op]
+        print("%s: %d ops, %.0f ops/s, p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms, verify cpu %.2fs, %d errors" %
+              (op, r['ops'], r['ops_per_sec'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms'],
+               r['verify_cpu_sec'], sum(r['errors'].values())))
+        for (name, n) in sorted(r['errors'].items()):
+            print("  %6d  %s" % (n, name))
+    if load.failed:
+        print("stopped early: a PUT failed, so the root is no longer known")
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
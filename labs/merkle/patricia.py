@@ -0,0 +1,126 @@
+import store
+from common import H_ext, traversal_path, PatriciaProof
+
+## Path-compressed trees.  In a plain Store, keys that share a long path
+## prefix hang below a chain of internal nodes, each with an empty sibling.
+## A PatriciaStore replaces every such chain with one ExtensionNode holding
+## the skipped bits, so every internal node branches and depths track
+## log2(N) however keys collide.  Roots and proofs (PatriciaProof) differ
+## from those of a plain Store, and Client checks them separately.
+
+class ExtensionNode(store.Node):
+    __slots__ = ('_skip', '_child')
+
+    def __init__(self, skip, child, hashval=None):
+        assert(skip and isinstance(child, store.InternalNode))
+        self._skip = skip
+        self._child = child
+        super().__init__(hashval)
+
+    def skip(self):
+        return self._skip
+
+    def child(self):
+        return self._child
+
+    def hashval(self):
+        if self._hashval is None:
+            self._hashval = H_ext(self._skip, self._child.hashval())
+        return self._hashval
+
+    def traverse(self, traversal):
+        return traversal.extension(self)
+
+    def walk(self, traversal):
+        return traversal.extension(self)
+
+def extend(skip, node):
+    if not skip:
+        return node
+    return ExtensionNode(skip, node)
+
+def branch(path, depth, new, other):
+    ## An internal node at depth with new on the side path takes.
+    children = [other, other]
+    children[int(path[depth])] = new
+    return store.InternalNode(children)
+
+def common_length(a, b):
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return n
+
+def patricia_proof(leaf, steps):
+    steps = [s if type(s) == str else s.hashval() for s in steps]
+    if isinstance(leaf, ExtensionNode):
+        return PatriciaProof(None, None, steps, (leaf.skip(), leaf.child().hashval()))
+    if isinstance(leaf, store.EmptyNode):
+        return PatriciaProof(None, None, steps)
+    return PatriciaProof(leaf.key(), leaf.val(), steps)
+
+class PatriciaLookupTraversal(store.LookupTraversal):
+    def extension(self, n):
+        ## A path that leaves the extension part way ends there.
+        (depth, skip) = (self._cur_depth, n.skip())
+        if self._path.bits(depth, depth + len(skip)) != skip:
+            return self.leaf(n)
+        self._siblings.append(skip)
+        self._cur_depth += len(skip)
+        return n.child().walk(self)
+
+    def proof(self):
+        return patricia_proof(self._leaf, self._siblings)
+
+class PatriciaInsertTraversal(store.InsertTraversal):
+    def leaf(self, n):
+        if self._leaf is None:
+            self._leaf = n
+            self._depth = len(self._siblings)
+
+        new = store.KeyValueNode(self._key, self._val)
+        if isinstance(n, store.EmptyNode) or n.key() == self._key:
+            return new
+
+        ## Branch where the two paths part, skipping the bits they share.
+        fork = self._path.common_prefix(traversal_path(n.key()))
+        return extend(self._path.bits(self._cur_depth, fork), branch(self._path, fork, new, n))
+
+    def extension(self, n):
+        (depth, skip) = (self._cur_depth, n.skip())
+        shared = common_length(self._path.bits(depth, depth + len(skip)), skip)
+        if shared == len(skip):
+            self._siblings.append(skip)
+            self._cur_depth += len(skip)
+            return ExtensionNode(skip, n.child().traverse(self))
+
+        ## Split the extension where the path leaves it.
+        if self._leaf is None:
+            self._leaf = n
+            self._depth = len(self._siblings)
+        rest = extend(skip[shared+1:], n.child())
+        new = store.KeyValueNode(self._key, self._val)
+        return extend(skip[:shared], branch(self._path, depth + shared, new, rest))
+
+    def proof(self):
+        return patricia_proof(self._leaf, self._siblings[:self._depth])
+
+class PatriciaStore(store.Store):
+    ## Single-key lookups and inserts, batches of inserts without proofs,
+    ## versions and the write-ahead log work as for Store.  Multiproofs
+    ## (lookup_many, insert_batch), parallel builds, sync.diff() and
+    ## DiskStore do not know about extensions.
+    lookup_traversal = PatriciaLookupTraversal
+    insert_traversal = PatriciaInsertTraversal
+
+    def _insert_items(self, items, workers=None):
+        root = self.root
+        for (k, v) in items.items():
+            root = root.traverse(PatriciaInsertTraversal(k, v))
+        self._update(root, items)
+
+    def lookup_many(self, keys, version=None):
+        raise Exception("multiproofs are not supported by PatriciaStore")
+
+    def subtrees(self, prefixes, version=None):
+        raise Exception("subtrees are not supported by PatriciaStore")
@@ -0,0 +1,96 @@
+import collections
+import threading
+import store
+from common import traversal_path, Proof
+
+## Encoded proofs of recently looked-up keys, kept in LRU order.  An insert
+## changes exactly one sibling of every other proof: the one at the depth
+## where the two paths part, which is the subtree the new key went into.
+## Inserts are only noted as they happen, so a write costs the same however
+## many entries there are.  An entry behind the version asked for has the
+## siblings of the inserts since patched in from the trees they made when
+## it is next asked for, which still skips the traversal; it is dropped if
+## one of those inserts reached its leaf, or was not noted (batches and
+## resets are not) or is no longer retained.
+class ProofCache:
+    def __init__(self, maxsize=4096, inserts=64):
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        ## version -> path of the key whose insert made it.
+        self._inserts = collections.OrderedDict()
+        self._max_inserts = inserts
+        self._store = None
+        self._lock = threading.Lock()
+
+    def get(self, key, version, fmt):
+        ## Return (proof, encoded bytes or None) for key at version, or None.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1].version > version:
+                return None
+            (path, proof, encoded) = entry
+            if proof.version == version:
+                self._entries.move_to_end(key)
+                return (proof, encoded.get(fmt))
+            inserts = None
+            if version - proof.version <= self._max_inserts:
+                inserts = [self._inserts.get(v) for v in range(proof.version + 1, version + 1)]
+            s = self._store
+
+        patched = None
+        if inserts is not None and None not in inserts:
+            patched = self._patch(s, path, proof, inserts)
+        with self._lock:
+            if self._entries.get(key) is entry:
+                if patched is None:
+                    del self._entries[key]
+                else:
+                    self._entries[key] = (path, patched, {})
+                    self._entries.move_to_end(key)
+        return None if patched is None else (patched, None)
+
+    def _patch(self, s, path, proof, inserts):
+        siblings = list(proof.siblings)
+        version = proof.version
+        for inserted in inserts:
+            version += 1
+            fork = inserted.common_prefix(path)
+            if fork >= len(siblings):
+                return None
+            try:
+                (_, node) = s.snapshot(version)
+            except Exception:
+                return None
+            for depth in range(fork + 1):
+                node = node._children[int(inserted[depth])]
+            siblings[fork] = node.hashval()
+        return Proof(proof.key, proof.val, siblings, version)
+
+    def put(self, key, proof, fmt, data):
+        if type(proof) != Proof or self._maxsize == 0:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] is not proof:
+                entry = (traversal_path(key), proof, {})
+                self._entries[key] = entry
+            entry[2][fmt] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._inserts.clear()
+
+    def inserted(self, s, key, version):
+        ## key was inserted, making version out of version - 1.
+        if not isinstance(s, store.Store):
+            return self.clear()
+        path = traversal_path(key)
+        with self._lock:
+            self._store = s
+            self._inserts[version] = path
+            while len(self._inserts) > self._max_inserts:
+                self._inserts.popitem(last=False)
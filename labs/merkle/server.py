@@ -1,30 +1,115 @@
+import argparse
 import flask
 import binascii
+import common
+import proofcache
 import store
+import wire
 
-def create_app():
+def create_app(s=None, proof_cache=4096):
     app = flask.Flask(__name__)
-    s = store.Store()
+    if s is None:
+        s = store.Store()
+    cache = proofcache.ProofCache(proof_cache)
 
-    def json_proof(p):
-        res = {
-            'siblings': [binascii.hexlify(s).decode('ascii') for s in p.siblings],
-        }
-        if p.key is not None:
-            res['key'] = binascii.hexlify(p.key).decode('ascii')
-            res['val'] = binascii.hexlify(p.val).decode('ascii')
-        return flask.jsonify(res)
+    def wants_binary():
+        best = flask.request.accept_mimetypes.best_match(['application/json', wire.BINARY_MIMETYPE])
+        return best == wire.BINARY_MIMETYPE
+
+    ## Every proof response says, in X-Merkle-Version, which store version
+    ## the proof is against.  Each write (PUT, batch insert or reset)
+    ## creates exactly one new version.
+    def send_proof(p, data=None):
+        ## data, if given, is p already encoded in the format asked for.
+        if wants_binary() and type(p) == wire.Proof:
+            res = flask.Response(data or wire.encode_proof(p), mimetype=wire.BINARY_MIMETYPE)
+        elif data is not None:
+            res = flask.Response(data, mimetype='application/json')
+        else:
+            res = flask.jsonify(wire.proof_to_json(p))
+        res.headers['X-Merkle-Version'] = str(p.version)
+        return res
+
+    def send_multiproof(mp):
+        if wants_binary():
+            res = flask.Response(wire.encode_multiproof(mp), mimetype=wire.BINARY_MIMETYPE)
+        else:
+            res = flask.jsonify(wire.multiproof_to_json(mp))
+        res.headers['X-Merkle-Version'] = str(mp.version)
+        return res
+
+    def check_version(version):
+        if version is not None and version not in s.versions():
+            flask.abort(410, "version %d is not retained" % version)
+        return version
 
     @app.route("/<hexkey>", methods=["GET"])
     def lookup(hexkey):
         key = binascii.unhexlify(hexkey)
-        return json_proof(s.lookup(key))
+        version = check_version(flask.request.args.get('version', type=int))
+        if version is not None:
+            return send_proof(s.lookup(key, version))
+
+        ## Current-version lookups go through the proof cache.
+        fmt = 'binary' if wants_binary() else 'json'
+        hit = cache.get(key, s.snapshot()[0], fmt)
+        (p, data) = hit if hit is not None else (s.lookup(key), None)
+        res = send_proof(p, data)
+        if data is None:
+            cache.put(key, p, fmt, res.get_data())
+        return res
+
+    @app.route("/lookup", methods=["POST"])
+    def lookup_many():
+        j = flask.request.get_json()
+        keys = [binascii.unhexlify(k) for k in j['keys']]
+        return send_multiproof(s.lookup_many(keys, check_version(j.get('version'))))
 
     @app.route("/<hexkey>", methods=["PUT"])
     def insert(hexkey):
         key = binascii.unhexlify(hexkey)
         val = flask.request.data
-        return json_proof(s.insert(key, val))
+        p = s.insert(key, val)
+        cache.inserted(s, key, p.version + 1)
+        return send_proof(p)
+
+    @app.route("/insert", methods=["POST"])
+    def insert_batch():
+        items = [(binascii.unhexlify(k), binascii.unhexlify(v)) for (k, v) in flask.request.get_json()['items']]
+        return send_multiproof(s.insert_batch(items))
+
+    @app.route("/changes", methods=["GET"])
+    def changes():
+        ## What a client whose root is ?root=<hex> needs to catch up.
+        if not hasattr(s, 'changes'):
+            flask.abort(501, "this store does not keep changes")
+        try:
+            (v, root_hash, reset, items, mp) = s.changes(binascii.unhexlify(flask.request.args['root']))
+        except KeyError:
+            flask.abort(400, "no root given")
+        except store.NotRetainedError as e:
+            flask.abort(410, str(e))
+        return flask.jsonify({
+            'version': v,
+            'root': wire.hexstr(root_hash),
+            'reset': reset,
+            'items': [(wire.hexstr(k), wire.hexstr(val)) for (k, val) in items.items()],
+            'multiproof': None if mp is None else wire.multiproof_to_json(mp),
+        })
+
+    @app.route("/subtrees", methods=["POST"])
+    def subtrees():
+        ## Lets another replica walk this tree for sync.diff().
+        j = flask.request.get_json()
+        for prefix in j['prefixes']:
+            if prefix.strip('01'):
+                flask.abort(400, "bad prefix %s" % prefix)
+        (v, ds) = s.subtrees(j['prefixes'], check_version(j.get('version')))
+        return flask.jsonify({'version': v, 'subtrees': [wire.subtree_to_json(d) for d in ds]})
+
+    @app.route("/versions", methods=["GET"])
+    def versions():
+        return flask.jsonify(s.versions())
 
     @app.route("/reset", methods=["POST"])
     def reset():
@@ -34,5 +119,43 @@ def create_app():
     return app
 
 if __name__ == '__main__':
-    app = create_app()
-    app.run(debug=True, port=6160)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", help="keep the tree on disk in this directory (e.g. data)")
+    parser.add_argument("--sync", default=False, action=argparse.BooleanOptionalAction, help="fsync every write")
+    parser.add_argument("--retain", default=16, type=int, help="number of versions to keep for historical lookups")
+    parser.add_argument("--compact-ratio", default=4.0, type=float, help="with --data-dir, compact the node file whenever it grows to this many times its compacted size (0 to turn off)")
+    parser.add_argument("--cache-mb", default=64, type=int, help="with --data-dir, memory for nodes loaded from disk")
+    parser.add_argument("--patricia", default=False, action=argparse.BooleanOptionalAction, help="compress paths with extension nodes (in memory only; no multiproofs)")
+    parser.add_argument("--shards", type=int, help="spread keys over this many worker processes (a power of two; in memory only; no /changes)")
+    parser.add_argument("--proof-cache", default=4096, type=int, help="number of encoded proofs to cache for hot keys (0 to turn off)")
+    parser.add_argument("--path-cache", default=0, type=int, help="number of key paths to remember for hot keys (0 to turn off)")
+    parser.add_argument("--wal", help="log writes to this file before acknowledging them, and replay it on startup")
+    args = parser.parse_args()
+
+    if args.retain < 1:
+        parser.error("--retain must be at least 1")
+    common.set_path_cache(args.path_cache)
+    if args.shards is not None:
+        import shard
+        if args.shards < 1 or args.shards & (args.shards - 1):
+            parser.error("--shards must be a power of two")
+        s = shard.ShardedStore(args.shards.bit_length() - 1, retain=args.retain)
+    elif args.patricia:
+        import patricia
+        s = patricia.PatriciaStore(retain=args.retain)
+    elif args.data_dir is not None:
+        import disk
+        s = disk.DiskStore(args.data_dir, sync=args.sync, retain=args.retain, cache_bytes=args.cache_mb * 2**20,
+                           compact_ratio=args.compact_ratio)
+    else:
+        s = store.Store(retain=args.retain)
+    if args.wal is not None:
+        if args.shards is not None:
+            parser.error("--wal does not work with --shards")
+        import wal
+        s.recover(wal.WriteAheadLog(args.wal))
+    app = create_app(s, args.proof_cache)
+    ## The reloader runs this block again in a watcher process, which would
+    ## start its own shard workers or replay and truncate the log.
+    reload = args.shards is None and args.wal is None and args.data_dir is None
+    app.run(debug=True, port=6160, threaded=True, use_reloader=reload)
@@ -0,0 +1,321 @@
+import bisect
+import collections
+import multiprocessing
+import threading
+import store
+from common import traversal_path, path_order, Proof, MultiProof, H_internal
+from sync import subtree_hash
+
+## A ShardedStore spreads keys over 2**bits worker processes by the first
+## bits of their paths: shard i holds every key whose path starts with i in
+## binary.  Each shard is a plain Store, and once it holds two keys its
+## subtree at prefix i is exactly the global tree's there.  The coordinator
+## keeps a summary of each shard (its subtree at prefix i, as described by
+## store.subtree()), hashes the top bits levels itself, and stitches those
+## into the proofs shards return, so clients see the same root and proofs
+## as with a single Store.  Writes to different shards run in parallel.
+##
+## Not supported: changes() (so the server's /changes and Client.catch_up()),
+## the write-ahead log, and keeping the tree on disk.
+
+def shard_main(conn, prefix, retain):
+    s = store.Store(retain)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            return
+        (op, args) = msg
+        try:
+            (error, res) = (None, getattr(s, op)(*args))
+        except Exception as e:
+            (error, res) = (str(e), None)
+        conn.send((error, res, s.version, store.subtree(s.root, prefix)))
+
+class Shard:
+    def __init__(self, prefix, retain):
+        (self._conn, child) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=shard_main, args=(child, prefix, retain), daemon=True)
+        self._process.start()
+        ## Held for a whole request and reply on the pipe; writers hold it
+        ## until the coordinator has taken in the shard's new summary, so
+        ## summaries are applied in the order the shard made them.
+        self.lock = threading.Lock()
+
+    def send(self, op, *args):
+        self._conn.send((op, args))
+
+    def recv(self):
+        ## Return (result, version, summary), or an Exception as result.
+        (error, res, version, summary) = self._conn.recv()
+        if error is not None:
+            res = Exception(error)
+        return (res, version, summary)
+
+    def call(self, op, *args):
+        with self.lock:
+            self.send(op, *args)
+            (res, version, summary) = self.recv()
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def close(self):
+        with self.lock:
+            self._conn.send(None)
+        self._process.join()
+
+class Top:
+    ## The top levels over the shard summaries, as a heap: node 1 is the
+    ## root, node n has children 2n and 2n+1, and shard i is node 2**bits+i.
+    ## Every node is described as in store.subtree(), with a lone leaf
+    ## pulled up as far as Store would put it.
+    def __init__(self, summaries):
+        n = len(summaries)
+        self.nodes = [None] * n + list(summaries)
+        for i in reversed(range(1, n)):
+            (l, r) = (self.nodes[2*i], self.nodes[2*i+1])
+            if l[0] == 'empty' and r[0] != 'internal':
+                self.nodes[i] = r
+            elif r[0] == 'empty' and l[0] != 'internal':
+                self.nodes[i] = l
+            else:
+                self.nodes[i] = ('internal', H_internal((subtree_hash(l), subtree_hash(r))), None)
+
+    def summaries(self):
+        return self.nodes[len(self.nodes) // 2:]
+
+class ShardedStore:
+    ## Every write moves the global version by one.  The coordinator keeps
+    ## the last retain (version, shard versions, top) states, and reads pin
+    ## each shard to its version in the state they use; a shard that has
+    ## since moved more than retain versions on fails the read.
+    def __init__(self, bits=2, retain=16):
+        if retain < 1:
+            raise Exception("retain must be at least 1")
+        self._bits = bits
+        self._shards = [Shard(format(i, '0%db' % bits) if bits else '', retain) for i in range(2**bits)]
+        empty = Top([('empty', None, None)] * 2**bits)
+        self._history = collections.deque([(0, (0,) * 2**bits, empty)], maxlen=retain)
+        self._write_lock = threading.Lock()
+
+    def close(self):
+        for shard in self._shards:
+            shard.close()
+
+    def _shard(self, path):
+        return int(path.bits(0, self._bits), 2) if self._bits else 0
+
+    def snapshot(self, version=None):
+        history = self._history
+        if version is None:
+            return history[-1]
+        for state in list(history):
+            if state[0] == version:
+                return state
+        raise Exception("version %d is not retained" % version)
+
+    def versions(self):
+        return [v for (v, _, _) in list(self._history)]
+
+    def root_hash(self, version=None):
+        return subtree_hash(self.snapshot(version)[2].nodes[1])
+
+    def _apply(self, changes):
+        ## Called with the write lock held; changes maps shard indexes to
+        ## their (version, summary) after a write.
+        (v, versions, top) = self._history[-1]
+        (versions, summaries) = (list(versions), top.summaries())
+        for (i, (version, summary)) in changes.items():
+            versions[i] = version
+            summaries[i] = summary
+        self._history.append((v + 1, tuple(versions), Top(summaries)))
+
+    def _call_many(self, calls):
+        ## Send calls, a dict of shard index to (op, args), to all those
+        ## shards before waiting on any, so they work in parallel.  Return
+        ## {index: (result, version, summary)}.
+        shards = sorted(calls)
+        for i in shards:
+            self._shards[i].lock.acquire()
+        try:
+            for i in shards:
+                self._shards[i].send(calls[i][0], *calls[i][1])
+            res = {i: self._shards[i].recv() for i in shards}
+        except:
+            for i in shards:
+                self._shards[i].lock.release()
+            raise
+        return res
+
+    def _release(self, shards):
+        for i in shards:
+            self._shards[i].lock.release()
+
+    def _groups(self, paths):
+        ## Split paths, sorted by path, into {shard: (lo, hi)}.
+        groups = {}
+        for (j, (path, _)) in enumerate(paths):
+            i = self._shard(path)
+            groups[i] = (groups.get(i, (j, j))[0], j + 1)
+        return groups
+
+    def _stitch(self, top, path, shard_proof):
+        ## Put the top levels above the proof of path from its shard; the
+        ## shard proof is only needed if the shard has an internal node.
+        siblings = []
+        n = 1
+        for depth in range(self._bits + 1):
+            (kind, key, val) = top.nodes[n]
+            if kind != 'internal':
+                return Proof(key, val, siblings)
+            if depth == self._bits:
+                break
+            bit = int(path[depth])
+            siblings.append(subtree_hash(top.nodes[2*n + 1 - bit]))
+            n = 2*n + bit
+        ## Below its prefix, the shard's tree is the global one; above it
+        ## the shard only has empty siblings.
+        return Proof(shard_proof.key, shard_proof.val, siblings + shard_proof.siblings[self._bits:])
+
+    def _multi_stitch(self, top, n, depth, paths, lo, hi, leaves, siblings, shard_proofs):
+        ## As store.multi_walk, over the top levels, then each shard's
+        ## multiproof for its part of paths.
+        (kind, key, val) = top.nodes[n]
+        if kind != 'internal':
+            for (_, j) in paths[lo:hi]:
+                leaves[j] = (key, val, depth)
+            return
+
+        shards = len(top.nodes) // 2
+        if n >= shards:
+            mp = shard_proofs[n - shards]
+            for ((_, j), leaf) in zip(paths[lo:hi], mp.leaves):
+                leaves[j] = leaf
+            ## Drop the shard's empty siblings above its prefix: those left
+            ## of the path come first, those right of it last.
+            ones = bin(n - shards).count('1')
+            siblings.extend(mp.siblings[ones:len(mp.siblings) - (self._bits - ones)])
+            return
+
+        mid = bisect.bisect_left(paths, True, lo, hi, key=lambda item: item[0][depth])
+        for (child, a, b) in ((2*n, lo, mid), (2*n + 1, mid, hi)):
+            if a == b:
+                siblings.append(subtree_hash(top.nodes[child]))
+            else:
+                self._multi_stitch(top, child, depth + 1, paths, a, b, leaves, siblings, shard_proofs)
+
+    def _multiproof(self, top, paths, nkeys, shard_proofs, version):
+        leaves = [None] * nkeys
+        siblings = []
+        if paths:
+            self._multi_stitch(top, 1, 0, paths, 0, len(paths), leaves, siblings, shard_proofs)
+        return MultiProof(leaves, siblings, version)
+
+    def lookup(self, key, version=None):
+        (v, versions, top) = self.snapshot(version)
+        path = traversal_path(key)
+        i = self._shard(path)
+        shard_proof = None
+        if top.summaries()[i][0] == 'internal':
+            shard_proof = self._shards[i].call('lookup', key, versions[i])
+        p = self._stitch(top, path, shard_proof)
+        p.version = v
+        return p
+
+    def lookup_many(self, keys, version=None):
+        (v, versions, top) = self.snapshot(version)
+        paths = sorted([(traversal_path(k), j) for (j, k) in enumerate(keys)], key=path_order)
+        summaries = top.summaries()
+        calls = {}
+        for (i, (lo, hi)) in self._groups(paths).items():
+            if summaries[i][0] == 'internal':
+                calls[i] = ('lookup_many', ([keys[j] for (_, j) in paths[lo:hi]], versions[i]))
+        results = self._call_many(calls)
+        self._release(calls)
+        shard_proofs = {}
+        for (i, (res, _, _)) in results.items():
+            if isinstance(res, Exception):
+                raise res
+            shard_proofs[i] = res
+        return self._multiproof(top, paths, len(keys), shard_proofs, v)
+
+    def insert(self, key, val, proof=True):
+        path = traversal_path(key)
+        i = self._shard(path)
+        shard = self._shards[i]
+        with shard.lock:
+            shard.send('insert', key, val)
+            (shard_proof, version, summary) = shard.recv()
+            if isinstance(shard_proof, Exception):
+                raise shard_proof
+            with self._write_lock:
+                (v, _, top) = self._history[-1]
+                self._apply({i: (version, summary)})
+        if not proof:
+            return None
+        p = self._stitch(top, path, shard_proof)
+        p.version = v
+        return p
+
+    def _write(self, op, items):
+        ## Send each shard its part of items, sorted by path, and move to
+        ## the new state once all have replied.  Return the state before
+        ## and the shards' results.
+        paths = sorted([(traversal_path(k), k) for k in items], key=path_order)
+        calls = {}
+        for (i, (lo, hi)) in self._groups(paths).items():
+            calls[i] = (op, ({k: items[k] for (_, k) in paths[lo:hi]},))
+        results = self._call_many(calls)
+        try:
+            with self._write_lock:
+                before = self._history[-1]
+                self._apply({i: (version, summary) for (i, (_, version, summary)) in results.items()})
+        finally:
+            self._release(calls)
+        for (res, _, _) in results.values():
+            if isinstance(res, Exception):
+                raise res
+        return (before, results)
+
+    def insert_many(self, items, proofs=False, workers=None):
+        ## Proofs, if asked for, are looked up after the write, and so may
+        ## reflect later writes as well.
+        items = dict(items)
+        self._write('insert_many', items)
+        if proofs:
+            return [self.lookup(k) for k in items]
+
+    def insert_batch(self, items):
+        items = dict(items)
+        ((v, _, top), results) = self._write('insert_batch', items)
+        keys = list(items)
+        paths = sorted([(traversal_path(k), j) for (j, k) in enumerate(keys)], key=path_order)
+        return self._multiproof(top, paths, len(keys), {i: res for (i, (res, _, _)) in results.items()}, v)
+
+    def reset(self):
+        results = self._call_many({i: ('reset', ()) for i in range(len(self._shards))})
+        try:
+            with self._write_lock:
+                self._apply({i: (version, summary) for (i, (_, version, summary)) in results.items()})
+        finally:
+            self._release(range(len(self._shards)))
+
+    def subtrees(self, prefixes, version=None):
+        (v, versions, top) = self.snapshot(version)
+        res = []
+        for prefix in prefixes:
+            n = 1
+            for bit in prefix[:self._bits]:
+                if top.nodes[n][0] != 'internal':
+                    break
+                n = 2*n + (bit == '1')
+            d = top.nodes[n]
+            if d[0] == 'internal' and len(prefix) > self._bits:
+                i = n - len(top.nodes) // 2
+                d = self._shards[i].call('subtrees', [prefix], versions[i])[1][0]
+            elif d[0] == 'leaf':
+                path = traversal_path(d[1])
+                if path.bits(0, len(prefix)) != prefix:
+                    d = ('empty', None, None)
+            res.append(d)
+        return (v, res)
@@ -1,4 +1,19 @@
-from common import H_empty, H_kv, H_internal, traversal_path, Proof
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import gc
+import threading
+import wal
+from common import H, H_empty, H_kv, H_internal, traversal_path, path_order, Proof, MultiProof
+
+## Raised for a version, root or run of changes the store no longer keeps.
+class NotRetainedError(Exception):
+    pass
+
+## Kept in place of the items of a write larger than Store.change_limit,
+## which changes() then can't report.
+BULK = 'bulk'
 
 class Traversal:
     def __init__(self, path):
@@ -18,25 +33,39 @@ class Traversal:
         return self._siblings
 
 class Node:
+    __slots__ = ('_hashval',)
+
     def __init__(self, hashval):
         self._hashval = hashval
 
     def hashval(self):
         return self._hashval
 
+    def walk(self, traversal):
+        return traversal.leaf(self)
+
 class EmptyNode(Node):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(H_empty())
 
     def traverse(self, traversal):
         return traversal.leaf(self)
 
+    def __reduce__(self):
+        ## Unpickle as the shared EMPTY instance.
+        return 'EMPTY'
+
 class KeyValueNode(Node):
-    def __init__(self, key, val):
+    __slots__ = ('_key', '_val')
+
+    def __init__(self, key, val, hashval=None):
         self._key = key
         self._val = val
-        h = H_kv(self._key, self._val)
-        super().__init__(h)
+        if hashval is None:
+            hashval = H_kv(self._key, self._val)
+        super().__init__(hashval)
 
     def key(self):
         return self._key
@@ -47,20 +76,40 @@ class KeyValueNode(Node):
     def traverse(self, traversal):
         return traversal.leaf(self)
 
+## Empty nodes carry no state, so the whole tree shares one.
+EMPTY = EmptyNode()
+
 class InternalNode(Node):
-    def __init__(self, children):
+    __slots__ = ('_children',)
+
+    def __init__(self, children, hashval=None):
         assert(len(children) == 2)
-        self._children = children
-        h = H_internal([c.hashval() for c in self._children])
-        super().__init__(h)
+        self._children = tuple(children)
+        ## Without a known hash the node starts out dirty; see hashval().
+        super().__init__(hashval)
+
+    def hashval(self):
+        ## Hash on first use and remember it.  A run of writes then hashes
+        ## each new node at most once, and not at all if a later write
+        ## replaces it before anyone asks for a root or proof.
+        if self._hashval is None:
+            self._hashval = H_internal([c.hashval() for c in self._children])
+        return self._hashval
 
     def traverse(self, traversal):
-        children = [c for c in self._children]
+        children = list(self._children)
         leaf_direction = traversal.next_direction()
         traversal.sibling(children[int(not leaf_direction)])
         children[int(leaf_direction)] = children[int(leaf_direction)].traverse(traversal)
         return InternalNode(children)
 
+    def walk(self, traversal):
+        ## Read-only: follow the path without copying or re-hashing nodes.
+        children = self._children
+        leaf_direction = traversal.next_direction()
+        traversal.sibling(children[int(not leaf_direction)])
+        return children[int(leaf_direction)].walk(traversal)
+
 def node_proof(leaf, siblings):
     if isinstance(leaf, EmptyNode):
         key = None
@@ -87,37 +136,403 @@ class InsertTraversal(Traversal):
         super().__init__(traversal_path(key))
         self._key = key
         self._val = val
-        self._proof = None
+        self._leaf = None
 
     def leaf(self, n):
-        if self._proof is None:
-            self._proof = node_proof(n, self._siblings)
+        ## Remember the proof's leaf and siblings, but only hash them if
+        ## proof() is called.
+        if self._leaf is None:
+            self._leaf = n
+            self._depth = len(self._siblings)
 
         if isinstance(n, EmptyNode) or n.key() == self._key:
             return KeyValueNode(self._key, self._val)
 
         ## Create an internal node, and keep traversing.
-        children = [EmptyNode(), EmptyNode()]
+        children = [EMPTY, EMPTY]
         existing_path = traversal_path(n.key())
         children[int(existing_path[self._cur_depth])] = n
         return InternalNode(children).traverse(self)
 
     def proof(self):
-        return self._proof
+        return node_proof(self._leaf, self._siblings[:self._depth])
+
+def multi_walk(node, paths, lo, hi, depth, leaves, siblings):
+    ## Collect the leaves for paths[lo:hi], which all lead to node, and the
+    ## hashes of subtrees that none of them enters.
+    if not isinstance(node, InternalNode):
+        if isinstance(node, EmptyNode):
+            leaf = (None, None, depth)
+        else:
+            leaf = (node.key(), node.val(), depth)
+        for (_, i) in paths[lo:hi]:
+            leaves[i] = leaf
+        return
+
+    children = node._children
+    mid = bisect.bisect_left(paths, True, lo, hi, key=lambda item: item[0][depth])
+    for (child, a, b) in ((children[0], lo, mid), (children[1], mid, hi)):
+        if a == b:
+            siblings.append(child.hashval())
+        else:
+            multi_walk(child, paths, a, b, depth + 1, leaves, siblings)
+
+def subtree(node, prefix):
+    ## Describe the subtree at prefix, a string of '0' and '1' bits, as
+    ## ('internal', hash, None), ('leaf', key, val) or ('empty', None, None).
+    ## A leaf that sits above prefix stands for that whole subtree when its
+    ## path continues into prefix; otherwise the subtree is empty.
+    for bit in prefix:
+        if not isinstance(node, InternalNode):
+            break
+        node = node._children[bit == '1']
+    if isinstance(node, InternalNode):
+        return ('internal', node.hashval(), None)
+    if isinstance(node, KeyValueNode):
+        path = traversal_path(node.key())
+        if all(path[depth] == (bit == '1') for (depth, bit) in enumerate(prefix)):
+            return ('leaf', node.key(), node.val())
+    return ('empty', None, None)
+
+def build(node, items, lo, hi, depth):
+    ## Merge items[lo:hi], sorted by path and all sharing the path prefix
+    ## up to depth, into the subtree rooted at node.  Each new internal
+    ## node is built (and hashed) exactly once.
+    if lo == hi:
+        return node
+
+    if isinstance(node, KeyValueNode):
+        if all(key != node.key() for (_, key, _) in items[lo:hi]):
+            ## Push the existing leaf down along with the new items.
+            items = items[lo:hi] + [(traversal_path(node.key()), node.key(), node.val())]
+            items.sort(key=path_order)
+            lo, hi = 0, len(items)
+        node = EMPTY
+
+    if isinstance(node, EmptyNode):
+        if hi - lo == 1:
+            (_, key, val) = items[lo]
+            return KeyValueNode(key, val)
+        children = [EMPTY, EMPTY]
+    else:
+        children = node._children
+
+    mid = bisect.bisect_left(items, True, lo, hi, key=lambda item: item[0][depth])
+    return InternalNode([build(children[0], items, lo, mid, depth + 1),
+                         build(children[1], items, mid, hi, depth + 1)])
+
+@contextlib.contextmanager
+def gc_paused():
+    ## Making nodes by the hundred thousand sets off the cyclic collector
+    ## over and over, though nodes never form cycles.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def build_top(subtrees, lo, hi):
+    ## Join the subtrees of consecutive prefixes lo..hi-1 (all of one
+    ## length) up to the subtree of their common prefix, pulling a lone
+    ## leaf up as build() would.
+    if hi - lo == 1:
+        return subtrees[lo]
+    mid = (lo + hi) // 2
+    (left, right) = (build_top(subtrees, lo, mid), build_top(subtrees, mid, hi))
+    if isinstance(left, EmptyNode) and not isinstance(right, InternalNode):
+        return right
+    if isinstance(right, EmptyNode) and not isinstance(left, InternalNode):
+        return left
+    return InternalNode((left, right))
+
+def flatten(node, index, ops):
+    ## Post-order list of plain values, which pickles far faster than the
+    ## nodes themselves: None for empty, (index[key], hash) for a leaf, and
+    ## the hash of an internal node after those of its children.
+    if isinstance(node, InternalNode):
+        for c in node._children:
+            flatten(c, index, ops)
+        ops.append(node.hashval())
+    elif isinstance(node, KeyValueNode):
+        ops.append((index[node.key()], node.hashval()))
+    else:
+        ops.append(None)
+    return ops
+
+def unflatten(ops, items):
+    ## Rebuild the nodes from flatten(), reusing the hashes it carries and
+    ## taking keys and values from the items it indexed.
+    stack = []
+    for op in ops:
+        if op is None:
+            stack.append(EMPTY)
+        elif type(op) == tuple:
+            (key, val) = items[op[0]]
+            stack.append(KeyValueNode(key, val, op[1]))
+        else:
+            right = stack.pop()
+            stack[-1] = InternalNode((stack[-1], right), op)
+    return stack[0]
+
+def build_subtree(items, depth):
+    ## Runs in a worker process: build and hash the subtree of items, a
+    ## list of (key, val) whose paths share their first depth bits.
+    with gc_paused():
+        paths = sorted([(traversal_path(k), k, v) for (k, v) in items], key=path_order)
+        root = build(EMPTY, paths, 0, len(paths), depth)
+        return flatten(root, {k: i for (i, (k, _)) in enumerate(items)}, [])
+
+def parallel_build(items, workers):
+    ## Build a fresh tree from items, a list of (key, val) with distinct
+    ## keys, handing the subtree of every split_depth-bit path prefix to a
+    ## process pool (hashlib holds the GIL for inputs this small, so
+    ## threads would not help).  Workers compute the paths themselves, so
+    ## only keys and values go out and hashes come back.  The result is
+    ## identical to build(EMPTY, items sorted by path, ...).
+    if workers <= 1:
+        paths = sorted([(traversal_path(k), k, v) for (k, v) in items], key=path_order)
+        return build(EMPTY, paths, 0, len(paths), 0)
+    split_depth = min(16, max(1, (4 * workers - 1).bit_length()))
+    groups = [[] for _ in range(2**split_depth)]
+    for (k, v) in items:
+        ## The first bits of traversal_path(k), without making the Path.
+        groups[int.from_bytes(H(k)[:2], 'big') >> (16 - split_depth)].append((k, v))
+    subtrees = [EMPTY] * len(groups)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for (i, group) in enumerate(groups):
+            if len(group) == 1:
+                subtrees[i] = KeyValueNode(*group[0])
+            elif group:
+                futures[i] = pool.submit(build_subtree, group, split_depth)
+        with gc_paused():
+            for (i, f) in futures.items():
+                subtrees[i] = unflatten(f.result(), groups[i])
+    return build_top(subtrees, 0, len(subtrees))
 
 class Store:
-    def __init__(self):
-        self.root = EmptyNode()
+    ## Nodes are never modified once built, so a reader only needs to grab
+    ## self.root once to get a consistent snapshot.  Writers are serialized
+    ## and publish a new root with a single assignment.
+    ##
+    ## Every write creates a new version.  The last retain (version, root)
+    ## pairs are kept so that proofs can be served against recent past
+    ## roots; since old and new roots share structure, this costs only the
+    ## nodes each write copied, and a node is freed as soon as no retained
+    ## root reaches it.
+    lookup_traversal = LookupTraversal
+    insert_traversal = InsertTraversal
+
+    def __init__(self, retain=16):
+        if retain < 1:
+            raise Exception("retain must be at least 1")
+        self.root = EMPTY
+        self.version = 0
+        self._history = collections.deque([(0, EMPTY)], maxlen=retain)
+        ## (version, change) for the writes that made each retained
+        ## version: a dict of the keys inserted, None for a reset, or BULK.
+        self._changes = collections.deque(maxlen=retain)
+        self.change_limit = 4096
+        self._write_lock = threading.Lock()
+        self.wal = None
+        self.checkpoint_bytes = 64 * 2**20
+
+    def snapshot(self, version=None):
+        ## Return (version, root) for the given retained version, or for
+        ## the current one.
+        history = self._history
+        if version is None:
+            return history[-1]
+        i = version - history[0][0]
+        if i >= 0:
+            try:
+                (v, root) = history[i]
+                if v == version:
+                    return (v, root)
+            except IndexError:
+                pass
+        raise NotRetainedError("version %d is not retained" % version)
+
+    def versions(self):
+        return [v for (v, _) in list(self._history)]
+
+    def lookup(self, key, version=None):
+        (v, root) = self.snapshot(version)
+        t = self.lookup_traversal(key)
+        root.walk(t)
+        p = t.proof()
+        p.version = v
+        return p
+
+    def lookup_many(self, keys, version=None):
+        (v, root) = self.snapshot(version)
+        paths = sorted([(traversal_path(k), i) for (i, k) in enumerate(keys)], key=path_order)
+        leaves = [None] * len(keys)
+        siblings = []
+        if paths:
+            multi_walk(root, paths, 0, len(paths), 0, leaves, siblings)
+        return MultiProof(leaves, siblings, v)
 
-    def lookup(self, key):
-        t = LookupTraversal(key)
-        self.root = self.root.traverse(t)
-        return t.proof()
+    def changes(self, root_hash):
+        ## Return (version, root hash, reset, items, multiproof): the current
+        ## version and its root hash, and the net effect of the writes since
+        ## the last retained version whose root hash is root_hash.  That is
+        ## the inserts made since (last value per key), and whether they
+        ## follow a reset; if not, multiproof covers their keys at that older
+        ## version, so that Client.catch_up() can check the new root follows
+        ## from it.  A bulk write since the last reset is not kept, and the
+        ## caller has to start over as after a reset it can't check.
+        with self._write_lock:
+            history = list(self._history)
+            changes = list(self._changes)
+            (version, root) = history[-1]
+        since = [v for (v, root) in history if root.hashval() == root_hash]
+        if not since:
+            raise NotRetainedError("root is not retained")
+        changes = [c for (v, c) in changes if v > since[-1]]
+        if len(changes) != version - since[-1]:
+            raise NotRetainedError("changes since version %d are not retained" % since[-1])
 
-    def insert(self, key, val):
-        t = InsertTraversal(key, val)
-        self.root = self.root.traverse(t)
-        return t.proof()
+        (reset, bulk, items) = (False, False, {})
+        for change in changes:
+            if change is None:
+                (reset, bulk, items) = (True, False, {})
+            elif change is BULK:
+                bulk = True
+            else:
+                items.update(change)
+        if bulk:
+            raise NotRetainedError("changes since version %d include a bulk write" % since[-1])
+        multiproof = None if reset else self.lookup_many(list(items), since[-1])
+        return (version, root.hashval(), reset, items, multiproof)
+
+    def subtrees(self, prefixes, version=None):
+        ## Return (version, descriptions) of the subtrees at prefixes, all
+        ## from one snapshot; see sync.diff().
+        (v, root) = self.snapshot(version)
+        return (v, [subtree(root, prefix) for prefix in prefixes])
+
+    def root_hash(self, version=None):
+        return self.snapshot(version)[1].hashval()
+
+    def insert(self, key, val, proof=True):
+        ## Without a proof, nothing is hashed until the root hash or a proof
+        ## is next asked for.
+        t = self.insert_traversal(key, val)
+        with self._write_lock:
+            version = self.version
+            lsn = self._log([(key, val)])
+            self._update(self.root.traverse(t), {key: val})
+            self._maybe_checkpoint()
+        self._wait_logged(lsn)
+        if not proof:
+            return None
+        p = t.proof()
+        p.version = version
+        return p
+
+    def insert_many(self, items, proofs=False, workers=None):
+        ## Same resulting tree as inserting each item in turn (later values
+        ## win), but built bottom-up.  If proofs is set, return a lookup
+        ## proof against the new root for each distinct key.  With workers,
+        ## an empty store is built in that many processes (not a DiskStore,
+        ## which builds in chunks to bound memory).
+        items = dict(items)
+        with self._write_lock:
+            lsn = self._log(items.items())
+            self._insert_items(items, workers)
+            self._maybe_checkpoint()
+            result = [self.lookup(k) for k in items] if proofs else None
+        self._wait_logged(lsn)
+        return result
+
+    def insert_batch(self, items):
+        ## Like insert_many, but return a multiproof for the distinct keys
+        ## (in first-seen order) against the root the batch was applied to,
+        ## as insert does for a single key.
+        items = dict(items)
+        with self._write_lock:
+            multiproof = self.lookup_many(list(items))
+            lsn = self._log(items.items())
+            self._insert_items(items)
+            self._maybe_checkpoint()
+        self._wait_logged(lsn)
+        return multiproof
+
+    def _insert_items(self, items, workers=None):
+        if workers and self.root is EMPTY:
+            self._update(parallel_build(list(items.items()), workers), items)
+            return
+        paths = sorted([(traversal_path(k), k, v) for (k, v) in items.items()], key=path_order)
+        self._update(build(self.root, paths, 0, len(paths), 0), items)
+
+    @classmethod
+    def from_items(cls, items, *args, workers=None, **kwargs):
+        s = cls(*args, **kwargs)
+        s.insert_many(items, workers=workers)
+        return s
 
     def reset(self):
-        self.root = EmptyNode()
+        with self._write_lock:
+            lsn = self._log([None])
+            self._update(EMPTY, None)
+            self._maybe_checkpoint()
+        self._wait_logged(lsn)
+
+    ## With a write-ahead log attached (see recover()), every write is
+    ## logged under the write lock, so the log order is the apply order.
+    ## The write is acknowledged only once its record is on disk, and
+    ## concurrent writers share fsyncs.
+    def _log(self, items):
+        lsn = None
+        if self.wal is not None:
+            for item in items:
+                if item is None:
+                    lsn = self.wal.append(wal.RESET)
+                else:
+                    lsn = self.wal.append(wal.INSERT, item[0], item[1])
+        return lsn
+
+    def _wait_logged(self, lsn):
+        if lsn is not None:
+            self.wal.wait(lsn)
+
+    def _maybe_checkpoint(self):
+        if self.wal is not None and self.wal.size() >= self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+        ## Called with the write lock held (or before the store is shared).
+        ## An in-memory store has nothing durable to checkpoint to, so its
+        ## log is kept whole and replayed from the start.
+        pass
+
+    def recover(self, log):
+        ## Replay log onto the last checkpoint and log writes to it from now
+        ## on.  Replaying records that the checkpoint already reflects is
+        ## harmless: the final value of every key, and so the tree, comes
+        ## out the same.
+        batch = {}
+        for (kind, key, val) in log.replay():
+            if kind == wal.RESET:
+                batch = {}
+                self.reset()
+                continue
+            batch[key] = val
+            if len(batch) >= 100000:
+                self.insert_many(batch)
+                batch = {}
+        if batch:
+            self.insert_many(batch)
+        self.wal = log
+        self.checkpoint()
+
+    def _update(self, root, change):
+        self._history.append((self.version + 1, root))
+        if change is not None and len(change) > self.change_limit:
+            change = BULK
+        self._changes.append((self.version + 1, change))
+        self.root = root
+        self.version += 1
@@ -0,0 +1,66 @@
+from common import H_empty, H_kv, traversal_path
+
+## Anti-entropy between two replicas.  Both trees are walked from the root
+## a level at a time, and only subtrees whose hashes differ are opened, so
+## finding d differing keys takes O(d * depth) subtree descriptions rather
+## than a lookup of every key.  A replica is anything with a subtrees()
+## method like Store's: a Store, or a cli.RemoteStore for a server.
+
+def subtree_hash(d):
+    (kind, a, b) = d
+    if kind == 'internal':
+        return a
+    if kind == 'leaf':
+        return H_kv(a, b)
+    return H_empty()
+
+def child(d, depth, bit):
+    ## A leaf or empty subtree needs no request to open: a leaf moves down
+    ## to the child its path goes through, and the other child is empty.
+    (kind, key, _) = d
+    if kind == 'leaf' and traversal_path(key)[depth] == (bit == '1'):
+        return d
+    return ('empty', None, None)
+
+def leaves(d):
+    (kind, key, val) = d
+    return {key: val} if kind == 'leaf' else {}
+
+def expand(replica, version, frontier, which):
+    ## Describe the children of every prefix in frontier, asking replica
+    ## only about those it holds as internal nodes.
+    prefixes = [prefix + bit for (prefix, pair) in frontier if pair[which][0] == 'internal' for bit in '01']
+    described = iter(replica.subtrees(prefixes, version)[1] if prefixes else [])
+    res = []
+    for (prefix, pair) in frontier:
+        for bit in '01':
+            if pair[which][0] == 'internal':
+                res.append(next(described))
+            else:
+                res.append(child(pair[which], len(prefix), bit))
+    return res
+
+def diff(a, b):
+    ## Yield (key, a_val, b_val) for every key whose value differs between
+    ## replicas a and b, with None for a missing key.  Each replica is read
+    ## at the version it had when the walk started, so it must retain that
+    ## version until the walk is done.
+    (va, [da]) = a.subtrees([''])
+    (vb, [db]) = b.subtrees([''])
+    frontier = [('', (da, db))]
+    while frontier:
+        opened = []
+        for (prefix, (da, db)) in frontier:
+            if subtree_hash(da) == subtree_hash(db):
+                continue
+            if da[0] != 'internal' and db[0] != 'internal':
+                (xs, ys) = (leaves(da), leaves(db))
+                for key in sorted(xs.keys() | ys.keys()):
+                    if xs.get(key) != ys.get(key):
+                        yield (key, xs.get(key), ys.get(key))
+                continue
+            opened.append((prefix, (da, db)))
+        children_a = expand(a, va, opened, 0)
+        children_b = expand(b, vb, opened, 1)
+        prefixes = [prefix + bit for (prefix, _) in opened for bit in '01']
+        frontier = list(zip(prefixes, zip(children_a, children_b)))
@@ -0,0 +1,103 @@
+import os
+import struct
+import threading
+import zlib
+
+## The log is a sequence of records, each an insert or a reset:
+##
+##   record := crc:u32 kind:u8 keylen:u32 vallen:u32 key val
+##
+## where crc covers everything after it.  A crash can leave a torn record
+## at the end; it was never acknowledged, so it is dropped on open.
+INSERT = 1
+RESET = 2
+header = struct.Struct('>IBII')
+
+def sync_dir(directory):
+    ## Make the entries of directory (files created, renamed or removed)
+    ## durable.  Windows can't open a directory, nor needs to.
+    if os.name == 'nt':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteAheadLog:
+    def __init__(self, path):
+        self._path = path
+        self._records = []
+        valid = 0
+        created = not os.path.exists(path)
+        with open(path, 'a+b') as f:
+            f.seek(0)
+            data = f.read()
+        while valid + header.size <= len(data):
+            (crc, kind, klen, vlen) = header.unpack_from(data, valid)
+            end = valid + header.size + klen + vlen
+            if end > len(data) or zlib.crc32(data[valid+4:end]) != crc:
+                break
+            key = data[valid+header.size:valid+header.size+klen]
+            self._records.append((kind, key, data[end-vlen:end]))
+            valid = end
+
+        self._f = open(path, 'ab')
+        self._f.truncate(valid)
+        if created:
+            ## Records synced into a file whose directory entry is not
+            ## would still be lost.
+            sync_dir(os.path.dirname(path))
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+    def replay(self):
+        ## The (kind, key, val) records found when the log was opened.
+        return self._records
+
+    def size(self):
+        return self._f.tell()
+
+    def append(self, kind, key=b'', val=b''):
+        ## Buffer a record and return its sequence number; wait() makes it
+        ## durable.  Callers append in the order the writes are applied.
+        body = struct.pack('>BII', kind, len(key), len(val)) + key + val
+        with self._cond:
+            self._f.write(struct.pack('>I', zlib.crc32(body)) + body)
+            self._written += 1
+            return self._written
+
+    def wait(self, lsn):
+        ## Group commit: the first writer to find its record not yet synced
+        ## flushes and fsyncs everything written so far, and writers that
+        ## arrive meanwhile wait for that fsync (or the next one) instead of
+        ## issuing their own.
+        with self._cond:
+            while self._synced < lsn:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                target = self._written
+                self._f.flush()
+                self._cond.release()
+                try:
+                    os.fsync(self._f.fileno())
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._synced = max(self._synced, target)
+
+    def truncate(self):
+        ## Called once everything logged so far is covered by a durable
+        ## checkpoint, which also makes those records count as synced.
+        with self._cond:
+            self._f.flush()
+            self._f.truncate(0)
+            self._f.seek(0)
+            self._records = []
+            self._synced = self._written
+            self._cond.notify_all()
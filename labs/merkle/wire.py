@@ -0,0 +1,191 @@
+import binascii
+import itertools
+import struct
+from common import Proof, PatriciaProof, MultiProof, CompressedSiblings
+
+## Proofs go over HTTP either as JSON with hex strings, or, for clients
+## that send "Accept: application/x-merkle-proof", in a length-prefixed
+## binary form:
+##
+##   leaf     := 0x00 | 0x01 keylen:u32 key vallen:u32 val
+##   siblings := count:u32 empty:bitmap width:u8 [len:u8*m] hash*m
+##
+## Bit i of the little-endian, ceil(count/8)-byte bitmap is set when
+## sibling i is H_empty(), and only the other m siblings are sent.  When
+## they all have the same length (always, for an honest server) it is given
+## once as width; otherwise width is 0 and a table of lengths follows.
+##   proof    := leaf siblings
+##   multi    := count:u32 (leaf depth:u16)* siblings
+BINARY_MIMETYPE = 'application/x-merkle-proof'
+
+u8 = struct.Struct('>B')
+u16 = struct.Struct('>H')
+u32 = struct.Struct('>I')
+
+def hexstr(b):
+    return binascii.hexlify(b).decode('ascii')
+
+def leaf_to_json(res, key, val):
+    if key is not None:
+        res['key'] = hexstr(key)
+        res['val'] = hexstr(val)
+    return res
+
+def leaf_from_json(j):
+    k = j.get('key')
+    v = j.get('val')
+    if k is not None: k = binascii.unhexlify(k)
+    if v is not None: v = binascii.unhexlify(v)
+    return (k, v)
+
+def proof_to_json(p):
+    if type(p) == PatriciaProof:
+        return patricia_to_json(p)
+    return leaf_to_json({'siblings': [hexstr(s) for s in p.siblings]}, p.key, p.val)
+
+def proof_from_json(j):
+    if 'steps' in j:
+        return patricia_from_json(j)
+    (k, v) = leaf_from_json(j)
+    return Proof(k, v, [binascii.unhexlify(s) for s in j['siblings']])
+
+## A Patricia proof's steps are hex sibling hashes and {"skip": bits}
+## objects; it only goes over HTTP as JSON.
+def patricia_to_json(p):
+    res = {'steps': [{'skip': s} if type(s) == str else hexstr(s) for s in p.steps]}
+    if p.ext is not None:
+        res['ext'] = {'skip': p.ext[0], 'child': hexstr(p.ext[1])}
+    return leaf_to_json(res, p.key, p.val)
+
+def patricia_from_json(j):
+    (k, v) = leaf_from_json(j)
+    steps = [s['skip'] if type(s) == dict else binascii.unhexlify(s) for s in j['steps']]
+    ext = j.get('ext')
+    if ext is not None:
+        ext = (ext['skip'], binascii.unhexlify(ext['child']))
+    return PatriciaProof(k, v, steps, ext)
+
+def multiproof_to_json(mp):
+    return {
+        'leaves': [leaf_to_json({'depth': depth}, key, val) for (key, val, depth) in mp.leaves],
+        'siblings': [hexstr(s) for s in mp.siblings],
+    }
+
+def multiproof_from_json(j):
+    leaves = [leaf_from_json(l) + (l['depth'],) for l in j['leaves']]
+    return MultiProof(leaves, [binascii.unhexlify(s) for s in j['siblings']])
+
+def encode_leaf(out, key, val):
+    if key is None:
+        out.append(0)
+    else:
+        out.append(1)
+        out += u32.pack(len(key))
+        out += key
+        out += u32.pack(len(val))
+        out += val
+
+def encode_siblings(out, siblings):
+    if type(siblings) != CompressedSiblings:
+        siblings = CompressedSiblings.compress(siblings)
+    out += u32.pack(len(siblings))
+    out += siblings.empty.to_bytes((len(siblings) + 7) // 8, 'little')
+    widths = set(len(s) for s in siblings.hashes)
+    if len(widths) == 1 and 0 not in widths:
+        out.append(widths.pop())
+    else:
+        out.append(0)
+        out += bytes(len(s) for s in siblings.hashes)
+    out += b''.join(siblings.hashes)
+
+def encode_proof(p):
+    out = bytearray()
+    encode_leaf(out, p.key, p.val)
+    encode_siblings(out, p.siblings)
+    return bytes(out)
+
+def encode_multiproof(mp):
+    out = bytearray()
+    out += u32.pack(len(mp.leaves))
+    for (key, val, depth) in mp.leaves:
+        encode_leaf(out, key, val)
+        out += u16.pack(depth)
+    encode_siblings(out, mp.siblings)
+    return bytes(out)
+
+class Reader:
+    def __init__(self, data):
+        self._data = bytes(data)
+        self._off = 0
+
+    def take(self, n):
+        if self._off + n > len(self._data):
+            raise Exception("Truncated proof")
+        b = self._data[self._off:self._off+n]
+        self._off += n
+        return b
+
+    def unpack(self, st):
+        if self._off + st.size > len(self._data):
+            raise Exception("Truncated proof")
+        (x,) = st.unpack_from(self._data, self._off)
+        self._off += st.size
+        return x
+
+    def leaf(self):
+        if self.unpack(u8) == 0:
+            return (None, None)
+        key = self.take(self.unpack(u32))
+        val = self.take(self.unpack(u32))
+        return (key, val)
+
+    def siblings(self):
+        count = self.unpack(u32)
+        empty = int.from_bytes(self.take((count + 7) // 8), 'little')
+        if empty >> count:
+            raise Exception("Bad sibling bitmap")
+        m = count - empty.bit_count()
+        width = self.unpack(u8)
+        if width:
+            ends = range(self._off, self._off + (m + 1) * width, width)
+        else:
+            ends = list(itertools.accumulate(self.take(m), initial=self._off))
+        if ends[-1] > len(self._data):
+            raise Exception("Truncated proof")
+        ## Slice all the hashes out in one comprehension rather than a loop
+        ## of reads.
+        data = self._data
+        self._off = ends[-1]
+        return CompressedSiblings(count, empty, [data[a:b] for (a, b) in itertools.pairwise(ends)])
+
+    def done(self):
+        if self._off != len(self._data):
+            raise Exception("Trailing bytes after proof")
+
+def decode_proof(data):
+    r = Reader(data)
+    (key, val) = r.leaf()
+    p = Proof(key, val, r.siblings())
+    r.done()
+    return p
+
+def decode_multiproof(data):
+    r = Reader(data)
+    leaves = [r.leaf() + (r.unpack(u16),) for _ in range(r.unpack(u32))]
+    mp = MultiProof(leaves, r.siblings())
+    r.done()
+    return mp
+
+def subtree_to_json(d):
+    (kind, a, b) = d
+    if kind == 'internal':
+        return {'hash': hexstr(a)}
+    return leaf_to_json({}, a, b)
+
+def subtree_from_json(j):
+    if 'hash' in j:
+        return ('internal', binascii.unhexlify(j['hash']), None)
+    (k, v) = leaf_from_json(j)
+    if k is None:
+        return ('empty', None, None)
+    return ('leaf', k, v)